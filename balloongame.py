@@ -14,8 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with Typing Turtle.  If not, see <http://www.gnu.org/licenses/>.
 
+import cairo
+import collections
 import math
-import random, datetime
+import random, datetime, time
 
 from gettext import gettext as _
 
@@ -25,7 +27,23 @@ from gi.repository import GObject
 from gi.repository import Pango
 from gi.repository import PangoCairo
 
-import medalscreen
+import medalscreen, latency
+from balloonstore import BalloonStore, StoredBalloon
+
+# Length of a game tick, in seconds.  The game moves on by whole ticks, however
+# often frames are drawn.
+TICK_TIME = 0.02
+
+# Longest time that is caught up in one frame, so that the game does not race
+# ahead after a stall.
+MAX_FRAME_TIME = 0.25
+
+# Range of ticks between new balloons in a storm.  Balloons take a few
+# hundred ticks to cross the screen, so a few hundred are up at once.
+STORM_DELAY = (1, 2)
+
+# Least number of balloons let go in a storm, whatever the lesson length.
+STORM_LENGTH = 2000
 
 BALLOON_COLORS = [
     (65535, 0, 0),
@@ -34,16 +52,27 @@ BALLOON_COLORS = [
     (0, 32768, 65535),
 ]
 
-class Balloon:
-    def __init__(self, x, y, vx, vy, word):
-        self.x = x
-        self.y = y
-        self.vx = vx
-        self.vy = vy
+# The position, velocity and size of a balloon live in the game's
+# BalloonStore, along with the width of its word once it is drawn.
+class Balloon(StoredBalloon):
+    def __init__(self, store, x, y, vx, vy, word, serial=0):
         self.word = word
         self.size = max(100, 50 + len(word) * 20) 
         self.color = random.choice(BALLOON_COLORS)
 
+        self.store = store
+        store.add(self, x, y, vx, vy, self.size)
+
+        # Balloons are typed in the order they were let go.
+        self.serial = serial
+
+        # Rendering of the word, redone when it changes.
+        self.word_surface = None
+        self.word_surface_word = None
+
+        # Area of the screen last queued for drawing the balloon.
+        self.drawn_rect = None
+
 class BalloonGame(Gtk.VBox):
     def __init__(self, lesson, activity):
         GObject.GObject.__init__(self)
@@ -80,23 +109,56 @@ class BalloonGame(Gtk.VBox):
         
         # Initialize the game data.
         self.balloons = []
+        self.store = BalloonStore()
+
+        # Storms let balloons go many at a time, for stress testing.
+        self.storm = self.lesson.get('options', {}).get('storm', False)
+
+        # Balloons by the first letter of their remaining word, each deque
+        # oldest first.
+        self.balloon_index = {}
 
         self.score = 0
         self.spawn_delay = 10
 
         self.count = 0
         self.count_left = self.lesson.get('length', 60)
+        if self.storm:
+            self.count_left = max(self.count_left, STORM_LENGTH)
 
         self.medal = None
         self.finished = False
 
-        # Start the animation loop running.        
-        self.update_timer = GObject.timeout_add(20, self.tick, priority=GObject.PRIORITY_HIGH_IDLE+30)
+        # Parts of the screen to redraw on the next frame.
+        self.damage = cairo.Region()
+
+        # Images of the parts of the screen which do not change.
+        self.background_surface = None
+        self.instructions_surface = None
+
+        # Balloon images with their strings, by (color, size).
+        self.balloon_surfaces = {}
+        self.word_font = Pango.FontDescription('Sans')
+        self.word_font.set_size(12 * Pango.SCALE)
+
+        # Measure input latency if requested, showing it in a corner.
+        self.latency = latency.get_probe('balloons')
+        self.latency_delay = 0
+
+        # The animation loop runs from the frame clock while the game is
+        # shown.  Balloons are drawn between their positions at the last two
+        # ticks, tick_alpha of the way along.
+        self.tick_id = None
+        self.frame_time = None
+        self.tick_lag = 0.0
+        self.tick_alpha = 1.0
     
     def realize_cb(self, widget):
         self.activity.add_events(Gdk.EventMask.KEY_PRESS_MASK)
         self.key_press_cb_id = self.activity.connect('key-press-event', self.key_cb)
 
+        self.start_ticks()
+
         # Clear the mouse cursor. 
         #pixmap = Gdk.Pixmap(widget.window, 10, 10)
         #color = Gdk.Color()
@@ -105,18 +167,22 @@ class BalloonGame(Gtk.VBox):
         
     def unrealize_cb(self, widget):
         self.activity.disconnect(self.key_press_cb_id)
+
+        self.stop_ticks()
+
+        if self.latency:
+            self.latency.dump()
     
     def stop_cb(self, widget):
         # Stop the animation loop.
-        if self.update_timer:
-            try:
-                GObject.source_remove(self.update_timer)
-            except:
-                pass # Try remove instance, if not found, just pass
+        self.stop_ticks()
         
         self.activity.pop_screen()
 
     def key_cb(self, widget, event):
+        # Time the key arrived, for the latency probe.
+        arrival_time = time.monotonic()
+
         # Ignore hotkeys.
         if event.get_state() & (Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.MOD1_MASK):
             return False
@@ -135,42 +201,112 @@ class BalloonGame(Gtk.VBox):
                     self.activity.push_screen(medalscreen.MedalScreen(self.medal, self.activity))
 
         else:
-            for b in self.balloons:
-                if b.word[0] == key:
-                    b.word = b.word[1:]
-                    self.add_score(1)
+            # The oldest balloon whose word starts with the key is typed.
+            balloons = self.balloon_index.get(key)
+            if balloons:
+                b = balloons[0]
+                if self.latency:
+                    self.latency.key_pressed(arrival_time)
+
+                self.unindex_balloon(b)
+                b.word = b.word[1:]
+                self.add_score(1)
+
+                self.queue_draw_balloon(b)
+
+                # Pop the balloon if it's been typed.
+                if len(b.word) == 0:
+                    self.balloons.remove(b)
+                    self.store.remove(b)
+                    self.add_score(100)
+                else:
+                    self.index_balloon(b)
+
+                self.flush_damage()
+        
+        return False
 
-                    # Pop the balloon if it's been typed.
-                    if len(b.word) == 0:
-                        self.balloons.remove(b)
-                        self.add_score(100)
+    def index_balloon(self, b):
+        balloons = self.balloon_index.setdefault(b.word[0], collections.deque())
 
-                    self.queue_draw_balloon(b)
+        # New balloons go at the end, while a balloon that was just typed may
+        # have to go before newer ones.
+        i = len(balloons)
+        while i > 0 and balloons[i-1].serial > b.serial:
+            i -= 1
+        balloons.insert(i, b)
 
-                    break
-        
-        return False
+    def unindex_balloon(self, b):
+        balloons = self.balloon_index[b.word[0]]
+        if balloons[0] is b:
+            balloons.popleft()
+        else:
+            balloons.remove(b)
+        if not balloons:
+            del self.balloon_index[b.word[0]]
     
-    def update_balloon(self, b):
-        b.x += b.vx
-        b.y += b.vy 
+    def start_ticks(self):
+        if not self.tick_id and not self.finished:
+            self.frame_time = None
+            self.tick_id = self.area.add_tick_callback(self.frame_cb)
+
+    def stop_ticks(self):
+        if self.tick_id:
+            self.area.remove_tick_callback(self.tick_id)
+        self.tick_id = None
+
+    def frame_cb(self, widget, frame_clock):
+        now = frame_clock.get_frame_time() / 1000000.0
+        if self.frame_time is None:
+            self.frame_time = now
+        elapsed = now - self.frame_time
+        self.frame_time = now
+
+        if self.advance(elapsed):
+            return True
+
+        self.tick_id = None
+        return False
 
-        if b.x < 100 or b.x >= self.bounds.width - 100:
-            b.vx = -b.vx
+    def advance(self, elapsed):
+        """Runs as many ticks as fit in the elapsed time, in seconds, and
+           redraws the balloons.  Returns False once the game is over."""
+        self.tick_lag += min(elapsed, MAX_FRAME_TIME)
 
-        if b.y < -100:
-            self.balloons.remove(b)
+        while self.tick_lag >= TICK_TIME:
+            self.tick_lag -= TICK_TIME
+            if not self.tick():
+                return False
+
+        self.tick_alpha = self.tick_lag / TICK_TIME
+
+        rects = self.store.get_rects(self.tick_alpha)
+        for b in self.balloons:
+            self.queue_draw_balloon(b, cairo.RectangleInt(*rects[b.slot]))
+        self.flush_damage()
+
+        return True
+
+    def get_balloon_pos(self, b):
+        """Returns where to draw a balloon, between its last two positions."""
+        x = b.prev_x + (b.x - b.prev_x) * self.tick_alpha
+        y = b.prev_y + (b.y - b.prev_y) * self.tick_alpha
+        return x, y
 
-        self.queue_draw_balloon(b)
-    
     def tick(self):
         if self.finished:
             return False
 
         self.bounds = self.area.get_allocation()
             
-        for b in self.balloons:
-            self.update_balloon(b)
+        # Move all the balloons, and forget those which floated away.
+        escaped = self.store.step(self.bounds.width)
+        if escaped:
+            for b in escaped:
+                self.queue_draw_balloon(b)
+                self.unindex_balloon(b)
+                self.store.remove(b)
+            self.balloons = [b for b in self.balloons if b.slot is not None]
 
         self.spawn_delay -= 1
         if self.count_left >= 0 and self.spawn_delay <= 0:
@@ -185,19 +321,30 @@ class BalloonGame(Gtk.VBox):
             vx = random.uniform(-2, 2)
             vy = -2 #random.uniform(-5, -3)
 
-            b = Balloon(x, y, vx, vy, word)
+            b = Balloon(self.store, x, y, vx, vy, word, self.count)
             self.balloons.append(b)
+            self.index_balloon(b)
 
-            if self.count < 10:
-                delay = 200
-            elif self.count < 20:
-                delay = 150
+            if self.storm:
+                self.spawn_delay = random.randint(*STORM_DELAY)
             else:
-                delay = 100
-            self.spawn_delay = random.randint(delay-20, delay+20)
+                if self.count < 10:
+                    delay = 200
+                elif self.count < 20:
+                    delay = 150
+                else:
+                    delay = 100
+                self.spawn_delay = random.randint(delay-20, delay+20)
 
         if self.count_left <= 0 and len(self.balloons) == 0:
             self.finish_game()
+
+        # Refresh the latency numbers about once a second.
+        if self.latency:
+            self.latency_delay -= 1
+            if self.latency_delay <= 0:
+                self.latency_delay = 50
+                self.damage.union(cairo.RectangleInt(0, 0, self.bounds.width, 40))
  
         return True
 
@@ -307,43 +454,91 @@ class BalloonGame(Gtk.VBox):
 
         self.queue_draw()
 
-    def queue_draw_balloon(self, b):
-        x = int(b.x - b.size/2) - 5
-        y = int(b.y - b.size/2) - 5
-        w = int(b.size + 100)
-        h = int(b.size*1.5 + 10)
-        self.area.queue_draw_area(x, y, w, h)
-
-    def draw_balloon(self, cr, b):
-        x = int(b.x)
-        y = int(b.y)
-
-        # Draw the string.
-        cr.set_source_rgb(0, 0, 0)
-        cr.move_to(int(b.x), int(b.y + b.size / 2))
-        cr.line_to(int(b.x), int(b.y + b.size))
-        cr.stroke()
-
-        # Draw the balloon.
-        cr.save()
-        cr.set_source_rgb(b.color[0], b.color[1], b.color[2])
-        cr.arc(b.x, b.y, b.size / 2, 0, 2 * math.pi)
-        cr.fill()
-        cr.restore()
-
-        cr.set_source_rgb(0, 0, 0)
-
-        pango_layout = PangoCairo.create_layout(cr)
-        fd = Pango.FontDescription('Sans')
-        fd.set_size(12 * Pango.SCALE)
-        pango_layout.set_font_description(fd)
-        pango_layout.set_text(b.word, len(b.word))
-        size = pango_layout.get_size()
-        x = x - (size[0] / Pango.SCALE) / 2
-        y = y - (size[1] / Pango.SCALE) / 2
-        cr.move_to(x, y)
-        PangoCairo.update_layout(cr, pango_layout)
-        PangoCairo.show_layout(cr, pango_layout)
+    def get_balloon_rect(self, b):
+        """Returns the area covered by a balloon, its string and its word."""
+        bx, by = self.get_balloon_pos(b)
+
+        # Long words can stick out of the sides of the balloon.
+        width = max(b.size, int(b.word_width))
+
+        r = b.size // 2 + 1
+        return cairo.RectangleInt(int(bx) - width // 2 - 1, int(by) - r,
+                                  width + 2, r + b.size + 1)
+
+    def queue_draw_balloon(self, b, rect=None):
+        """Adds where a balloon was drawn, and where it is now, to the area
+           redrawn by flush_damage.  rect is where it is now, if known."""
+        if b.drawn_rect is not None:
+            self.damage.union(b.drawn_rect)
+        if rect is None:
+            rect = self.get_balloon_rect(b)
+        b.drawn_rect = rect
+        self.damage.union(b.drawn_rect)
+
+    def flush_damage(self):
+        """Queues a single redraw of all the damaged areas."""
+        if not self.damage.is_empty():
+            self.area.queue_draw_region(self.damage)
+            self.damage = cairo.Region()
+
+    def get_balloon_surface(self, cr, b):
+        """Returns the image of a balloon with its string, and the offset of
+           the balloon's center in it."""
+        key = (b.color, b.size)
+        surface = self.balloon_surfaces.get(key)
+        r = b.size // 2 + 1
+        if surface is None:
+            surface = cr.get_target().create_similar(
+                cairo.CONTENT_COLOR_ALPHA, b.size + 2, r + b.size + 1)
+            surface_cr = cairo.Context(surface)
+
+            # Draw the string.
+            surface_cr.set_source_rgb(0, 0, 0)
+            surface_cr.move_to(r, r + b.size / 2)
+            surface_cr.line_to(r, r + b.size)
+            surface_cr.stroke()
+
+            # Draw the balloon.
+            surface_cr.set_source_rgb(b.color[0], b.color[1], b.color[2])
+            surface_cr.arc(r, r, b.size / 2, 0, 2 * math.pi)
+            surface_cr.fill()
+
+            self.balloon_surfaces[key] = surface
+        return surface, r
+
+    def get_word_surface(self, cr, b):
+        """Returns the image of a balloon's word, rendering it again only if
+           a letter was typed since."""
+        if b.word_surface_word != b.word:
+            pango_layout = PangoCairo.create_layout(cr)
+            pango_layout.set_font_description(self.word_font)
+            pango_layout.set_text(b.word, len(b.word))
+            w, h = pango_layout.get_pixel_size()
+
+            surface = cr.get_target().create_similar(
+                cairo.CONTENT_COLOR_ALPHA, max(w, 1), max(h, 1))
+            surface_cr = cairo.Context(surface)
+            surface_cr.set_source_rgb(0, 0, 0)
+            PangoCairo.update_layout(surface_cr, pango_layout)
+            PangoCairo.show_layout(surface_cr, pango_layout)
+
+            b.word_surface = surface
+            b.word_surface_word = b.word
+            b.word_width = surface.get_width()
+        return b.word_surface
+
+    def draw_balloon(self, cr, b, x, y):
+        """Draws a balloon centered on the given point."""
+        # Draw the balloon and its string.
+        surface, r = self.get_balloon_surface(cr, b)
+        cr.set_source_surface(surface, x - r, y - r)
+        cr.paint()
+
+        # Draw the word centered on the balloon.
+        surface = self.get_word_surface(cr, b)
+        cr.set_source_surface(surface,
+            x - surface.get_width() // 2, y - surface.get_height() // 2)
+        cr.paint()
 
     def add_score(self, num):
         self.score += num
@@ -352,10 +547,10 @@ class BalloonGame(Gtk.VBox):
     def queue_draw_score(self):
         layout = self.area.create_pango_layout(_('SCORE: %d') % self.score)
         layout.set_font_description(Pango.FontDescription('Times 14'))
-        size = layout.get_size()
-        x = self.bounds.width-20-size[0]/Pango.SCALE
+        w, h = layout.get_pixel_size()
+        x = self.bounds.width - 20 - w
         y = 20
-        self.queue_draw_area(x, y, x+size[0], y+size[1])
+        self.damage.union(cairo.RectangleInt(x - 1, y, w + 2, h + 1))
 
     def draw_score(self, cr):
         cr.set_source_rgb(0, 0, 0)
@@ -374,30 +569,69 @@ class BalloonGame(Gtk.VBox):
         PangoCairo.show_layout(cr, pango_layout)
 
     def draw_instructions(self, cr):
-        # Draw instructions.
+        # The instructions are rendered once, and copied to the screen.
+        if self.instructions_surface is None:
+            pango_layout = PangoCairo.create_layout(cr)
+            pango_layout.set_font_description(Pango.FontDescription('Times 14'))
+            text = _('Type the words to pop the balloons!')
+            pango_layout.set_text(text, len(text))
+            w, h = pango_layout.get_pixel_size()
+
+            surface = cr.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA, w, h)
+            surface_cr = cairo.Context(surface)
+            surface_cr.set_source_rgb(0, 0, 0)
+            PangoCairo.update_layout(surface_cr, pango_layout)
+            PangoCairo.show_layout(surface_cr, pango_layout)
+            self.instructions_surface = surface
+
+        surface = self.instructions_surface
+        x = (self.bounds.width - surface.get_width()) // 2
+        y = self.bounds.height - 20 - surface.get_height()
+        cr.set_source_surface(surface, x, y)
+        cr.paint()
+
+    def get_background_surface(self, cr):
+        surface = self.background_surface
+        if surface is None or surface.get_width() != self.bounds.width or \
+           surface.get_height() != self.bounds.height:
+            surface = cr.get_target().create_similar(
+                cairo.CONTENT_COLOR, self.bounds.width, self.bounds.height)
+            surface_cr = cairo.Context(surface)
+            surface_cr.set_source_rgb(0.915, 0.915, 1)
+            surface_cr.paint()
+            self.background_surface = surface
+        return surface
+
+    def draw_latency(self, cr):
         cr.set_source_rgb(0, 0, 0)
         pango_layout = PangoCairo.create_layout(cr)
-        pango_layout.set_font_description(Pango.FontDescription('Times 14'))
-        text = _('Type the words to pop the balloons!')
+        pango_layout.set_font_description(Pango.FontDescription('Monospace 9'))
+        text = self.latency.get_summary()
         pango_layout.set_text(text, len(text))
-        size = pango_layout.get_size()
-        x = (self.bounds.width - size[0] / Pango.SCALE) / 2
-        y = self.bounds.height - 20 - size[1] / Pango.SCALE
-        cr.move_to(x, y)
+        cr.move_to(10, 10)
         PangoCairo.update_layout(cr, pango_layout)
         PangoCairo.show_layout(cr, pango_layout)
 
     def draw(self, cr):
         self.bounds = self.area.get_allocation()
 
+        # Only the damaged parts of the screen are drawn.
+        visible, clip = Gdk.cairo_get_clip_rectangle(cr)
+        if not visible:
+            return
+
         # Draw background.
-        cr.set_source_rgb(0.915, 0.915, 1)
-        cr.rectangle(0, 0, self.bounds.width, self.bounds.height)
-        cr.fill()
+        cr.set_source_surface(self.get_background_surface(cr), 0, 0)
+        cr.paint()
 
-        # Draw the balloons.
+        # Draw the balloons, in the order they were let go.
+        rects = self.store.get_rects(self.tick_alpha)
         for b in self.balloons:
-            self.draw_balloon(cr, b)
+            x, y, w, h = rects[b.slot]
+            if x < clip.x + clip.width and clip.x < x + w and \
+               y < clip.y + clip.height and clip.y < y + h:
+                # The balloon's center, as placed by get_rects.
+                self.draw_balloon(cr, b, x + w // 2, y + b.size // 2 + 1)
 
         if self.finished:
             self.draw_results(cr)
@@ -406,5 +640,11 @@ class BalloonGame(Gtk.VBox):
 
             self.draw_score(cr)
 
+        if self.latency:
+            self.draw_latency(cr)
+
     def draw_cb(self, area, cr):
         self.draw(cr)
+
+        if self.latency:
+            self.latency.painted()
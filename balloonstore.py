@@ -0,0 +1,180 @@
+# Copyright 2008 by Kate Scheppke and Wade Brainerd.
+# This file is part of Typing Turtle.
+#
+# Typing Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Typing Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Typing Turtle.  If not, see <http://www.gnu.org/licenses/>.
+# vi:sw=4 et
+
+# Import standard Python modules.
+import array
+
+# NumPy is optional.  Without it the balloons are moved one at a time.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Balloons floating further off the top of the screen than this are gone.
+ESCAPE_Y = -100
+
+# Distance from the sides of the screen at which balloons bounce back.
+BOUNCE_MARGIN = 100
+
+# Positions, velocities and sizes of the balloons in a game.
+#
+# Each field is one array, with a slot for each balloon, so that a tick can
+# move every balloon at once, and a frame can find where to draw them all.  Removing a balloon moves the last one into its
+# slot, keeping the used slots together at the start of the arrays.
+class BalloonStore:
+    FIELDS = ('x', 'y', 'prev_x', 'prev_y', 'vx', 'vy', 'size', 'word_width')
+
+    # Number of slots allocated at first.
+    CAPACITY = 64
+
+    def __init__(self, capacity=CAPACITY, use_numpy=True):
+        self.use_numpy = use_numpy and numpy is not None
+        self.capacity = 0
+        self.count = 0
+
+        # Balloon owning each slot.
+        self.owners = []
+
+        for name in BalloonStore.FIELDS:
+            setattr(self, name, self._make_array(0))
+        self._grow(capacity)
+
+    def _make_array(self, size):
+        if self.use_numpy:
+            return numpy.zeros(size)
+        return array.array('d', [0.0]) * size
+
+    def _grow(self, capacity):
+        for name in BalloonStore.FIELDS:
+            old = getattr(self, name)
+            new = self._make_array(capacity)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def add(self, balloon, x, y, vx, vy, size):
+        """Gives a balloon the next free slot."""
+        if self.count == self.capacity:
+            self._grow(self.capacity * 2)
+
+        i = self.count
+        self.x[i] = self.prev_x[i] = x
+        self.y[i] = self.prev_y[i] = y
+        self.vx[i] = vx
+        self.vy[i] = vy
+        self.size[i] = size
+        self.word_width[i] = 0
+
+        self.owners.append(balloon)
+        balloon.slot = i
+        self.count += 1
+
+    def remove(self, balloon):
+        i = balloon.slot
+        last = self.count - 1
+        if i != last:
+            for name in BalloonStore.FIELDS:
+                a = getattr(self, name)
+                a[i] = a[last]
+            moved = self.owners[last]
+            self.owners[i] = moved
+            moved.slot = i
+        self.owners.pop()
+        self.count -= 1
+        balloon.slot = None
+
+    def step(self, width):
+        """Moves every balloon by its velocity, bouncing off the sides of a
+           screen of the given width.  Returns the balloons which floated
+           away; they are left in the store."""
+        n = self.count
+        if self.use_numpy:
+            x, y = self.x[:n], self.y[:n]
+            vx, vy = self.vx[:n], self.vy[:n]
+
+            self.prev_x[:n] = x
+            self.prev_y[:n] = y
+            x += vx
+            y += vy
+
+            bounce = (x < BOUNCE_MARGIN) | (x >= width - BOUNCE_MARGIN)
+            vx[bounce] = -vx[bounce]
+
+            return [self.owners[i] for i in numpy.flatnonzero(y < ESCAPE_Y)]
+
+        x, y = self.x, self.y
+        vx, vy = self.vx, self.vy
+        escaped = []
+        for i in range(n):
+            self.prev_x[i] = x[i]
+            self.prev_y[i] = y[i]
+            x[i] += vx[i]
+            y[i] += vy[i]
+
+            if x[i] < BOUNCE_MARGIN or x[i] >= width - BOUNCE_MARGIN:
+                vx[i] = -vx[i]
+
+            if y[i] < ESCAPE_Y:
+                escaped.append(self.owners[i])
+        return escaped
+
+    def get_rects(self, alpha):
+        """Returns the area covered by each balloon, with its string and its
+           word, drawn alpha of the way from its previous position to its
+           current one.  The areas are (x, y, width, height) tuples, by
+           slot."""
+        n = self.count
+        if self.use_numpy:
+            x = (self.prev_x[:n] + (self.x[:n] - self.prev_x[:n]) * alpha).astype(int)
+            y = (self.prev_y[:n] + (self.y[:n] - self.prev_y[:n]) * alpha).astype(int)
+            size = self.size[:n].astype(int)
+
+            # Long words can stick out of the sides of the balloon.
+            width = numpy.maximum(size, self.word_width[:n].astype(int))
+
+            r = size // 2 + 1
+            return list(zip((x - width // 2 - 1).tolist(), (y - r).tolist(),
+                            (width + 2).tolist(), (r + size + 1).tolist()))
+
+        rects = []
+        for i in range(n):
+            x = int(self.prev_x[i] + (self.x[i] - self.prev_x[i]) * alpha)
+            y = int(self.prev_y[i] + (self.y[i] - self.prev_y[i]) * alpha)
+            size = int(self.size[i])
+            width = max(size, int(self.word_width[i]))
+
+            r = size // 2 + 1
+            rects.append((x - width // 2 - 1, y - r, width + 2, r + size + 1))
+        return rects
+
+def _field(name):
+    def get(self):
+        return getattr(self.store, name)[self.slot]
+    def set(self, value):
+        getattr(self.store, name)[self.slot] = value
+    return property(get, set)
+
+# Base class of objects kept in a BalloonStore, whose fields read and write
+# their slot of the store's arrays.  Only valid while in the store.
+class StoredBalloon:
+    x = _field('x')
+    y = _field('y')
+    prev_x = _field('prev_x')
+    prev_y = _field('prev_y')
+    vx = _field('vx')
+    vy = _field('vy')
+    word_width = _field('word_width')
@@ -17,7 +17,6 @@
 # vi:sw=4 et 
 
 import cairo
-import copy
 import os, glob, re
 from gi.repository import Gtk
 from gi.repository import Pango
@@ -25,10 +24,12 @@ from gi.repository import PangoCairo
 from gi.repository import Gdk
 from gi.repository import GObject
 from gi.repository import GdkPixbuf
+from gi.repository import GLib
 
-import io
 import json
+import logging
 import subprocess
+import threading
 from layouts.olpc import OLPC_LAYOUT
 from layouts.olpcm import OLPCM_LAYOUT
 
@@ -38,6 +39,14 @@ HAND_YOFFSET = -15
 # Unicode symbol for the paragraph key.
 PARAGRAPH_CODE = '\xb6'
 
+# Font used for the key labels.
+KEY_LABEL_FONT = 'Monospace'
+KEY_LABEL_SIZE = 10
+
+# Modifiers which change the letters shown on the keys.  Other modifiers, such
+# as Caps Lock and Num Lock, are left out of the rendered keyboard cache.
+LABEL_STATE_MASK = Gdk.ModifierType.SHIFT_MASK | Gdk.ModifierType.MOD5_MASK
+
 # List of all key properties in the keyboard layout description.
 #
 # Keyboard Layouts use a property inheritance scheme similar to CSS (cascading style sheets):
@@ -92,26 +101,139 @@ KEY_PROPS = [
     # Which finger should be used to press the key.  
     # Options are [LR][TIMRP], so LM would mean the left middle finger.
     { 'name': 'key-finger', 'default': '' },
-
-    # True if the key is currently pressed.
-    { 'name': 'key-pressed', 'default': False },
 ]
 
+KEY_PROPS_DEFAULTS = dict((p['name'], p['default']) for p in KEY_PROPS)
+
+class Key:
+    """A key of a compiled keyboard layout, with all properties resolved."""
+    __slots__ = (
+        'index', 'group_index',
+        'x', 'y', 'width', 'height',
+        'scan', 'label', 'hand_image', 'finger',
+    )
+
+# Compiled layouts, keyed by layout name and the size the keys were scaled
+# to.  Keys are shared between keyboards and must not be modified.
+_compiled_layouts = {}
+
+# The keyboard model reported by setxkbmap, cached for the whole process
+# since querying it means spawning a subprocess.  None means not queried yet.
+_keyboard_model = None
+_keyboard_model_lock = threading.Lock()
+_keyboard_model_query = None
+_keymap_watched = False
+
+def _query_keyboard_model():
+    """Returns the keyboard model reported by setxkbmap, or '' if unknown."""
+    code = ''
+    try:
+        p = subprocess.Popen(["setxkbmap", "-query"], stdout=subprocess.PIPE)
+        out, err = p.communicate()
+    except OSError:
+        logging.warning('Unable to run setxkbmap to detect the keyboard model.')
+        return code
+
+    for line in out.decode('utf-8').splitlines():
+        if line.startswith('model:'):
+            code = line.split()[1]
+    return code
+
+def set_keyboard_model_query(query):
+    """Replaces the function used to detect the keyboard model, for example
+       with a lambda returning a fixed model when running headless.  Passing
+       None restores detection through setxkbmap."""
+    global _keyboard_model_query
+    _keyboard_model_query = query
+    invalidate_keyboard_model()
+
+def invalidate_keyboard_model():
+    """Forgets the cached keyboard model, so that it is queried again."""
+    global _keyboard_model
+    with _keyboard_model_lock:
+        _keyboard_model = None
+
+def _keys_changed_cb(keymap):
+    invalidate_keyboard_model()
+
+def _watch_keymap():
+    # The model can only change along with the keymap, so re-query then.
+    global _keymap_watched
+    if _keymap_watched:
+        return
+    display = Gdk.Display.get_default()
+    if display:
+        Gdk.Keymap.get_for_display(display).connect('keys-changed', _keys_changed_cb)
+        _keymap_watched = True
+
+def get_keyboard_model():
+    """Returns the keyboard model code, querying it only once per process."""
+    global _keyboard_model
+    with _keyboard_model_lock:
+        if _keyboard_model is None:
+            query = _keyboard_model_query or _query_keyboard_model
+            _keyboard_model = query()
+        return _keyboard_model
+
+def start_keyboard_model_query():
+    """Detects the keyboard model in a background thread, so that the first
+       keyboard shown does not wait on setxkbmap.  Call from the main thread."""
+    _watch_keymap()
+    thread = threading.Thread(target=get_keyboard_model)
+    thread.daemon = True
+    thread.start()
+
+def _get_key_prop(name, *sources):
+    """Looks up a key property in layout description dictionaries, ordered
+       from least to most specific, falling back to the default value."""
+    for source in reversed(sources):
+        if name in source:
+            return source[name]
+    return KEY_PROPS_DEFAULTS[name]
+
+# Shaped key label layouts, keyed by (text, size).  They share one Pango
+# context, and are discarded when the font map or its resolution changes.
+_label_layouts = {}
+_label_context = None
+_label_font_map = None
+_label_resolution = None
+
+def _get_label_layout(cr, text, size):
+    """Returns a Pango layout showing a key label, reusing the shaping
+       done for earlier keys and frames."""
+    global _label_layouts, _label_context, _label_font_map, _label_resolution
+
+    font_map = PangoCairo.FontMap.get_default()
+    resolution = font_map.get_resolution()
+    if font_map != _label_font_map or resolution != _label_resolution:
+        _label_layouts = {}
+        _label_context = font_map.create_context()
+        _label_font_map = font_map
+        _label_resolution = resolution
+
+    # Only changes to the context invalidate the cached layouts.
+    PangoCairo.update_context(cr, _label_context)
+
+    pango_layout = _label_layouts.get((text, size))
+    if pango_layout is None:
+        fd = Pango.FontDescription(KEY_LABEL_FONT)
+        fd.set_size(size * Pango.SCALE)
+
+        pango_layout = Pango.Layout.new(_label_context)
+        pango_layout.set_font_description(fd)
+        pango_layout.set_text(text, -1)
+        _label_layouts[(text, size)] = pango_layout
+
+    return pango_layout
+
 def _is_olpcm_model():
-    """Check via setxkbmap if the keyboard model is olpcm.
+    """Check if the keyboard model is olpcm.
 
     Keyboard model code is 'olpcm' for non-membrane, mechanical
     keyboard, and 'olpc' for membrane keyboard.
 
     """
-    code = None
-    p = subprocess.Popen(["setxkbmap", "-query"], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    
-    for line in out.decode('utf-8').splitlines():
-        if line.startswith('model:'):
-            code = line.split()[1]
-    return code == 'olpcm'
+    return get_keyboard_model() == 'olpcm'
 
 def get_layout():
     if _is_olpcm_model():
@@ -121,10 +243,21 @@ def get_layout():
 
 
 class KeyboardImages:
-    def __init__(self, width, height):
+    # Hand images shown when no key is highlighted, or for shifted letters.
+    # These are kept in memory from startup; the rest are only rasterized
+    # into the disk cache, and loaded from there when a lesson needs them.
+    PREWARM_IMAGES = [
+        'OLPC_Lhand_HOMEROW.svg', 'OLPC_Rhand_HOMEROW.svg',
+        'OLPC_Lhand_SHIFT.svg', 'OLPC_Rhand_SHIFT.svg',
+    ]
+
+    def __init__(self, width, height, cache_dir=None):
         self.width = width
         self.height = height
 
+        # Directory where rasterized images are kept between sessions.
+        self.cache_dir = cache_dir
+
         self.images = {}
 
     def get_image(self, name):
@@ -134,18 +267,135 @@ class KeyboardImages:
         return self.images[name]
 
     def load_image(self, name):
+        self.images[os.path.basename(name)] = self._rasterize(name)
+
+    def prewarm(self):
+        """Rasterizes the hand images in a background thread, so that they
+           are ready before the first lesson needs them.  The default hand
+           images are loaded, and the others are written to the disk cache.
+           Also removes images cached for other screen sizes or keyboard
+           models."""
+        names = [os.path.basename(f) for f in glob.glob('images/OLPC*hand_*.svg')]
+        names = [n for n in names if n not in self.images]
+
+        # Load the default hands first.
+        names.sort(key=lambda n: n not in KeyboardImages.PREWARM_IMAGES)
+
+        thread = threading.Thread(target=self._prewarm_thread, args=(names,))
+        thread.daemon = True
+        thread.start()
+
+    def _prewarm_thread(self, names):
+        self._remove_stale_caches()
+
+        for name in names:
+            keep = name in KeyboardImages.PREWARM_IMAGES
+
+            # The others are only rasterized into the disk cache, if there
+            # is one and they are not already in it.
+            if not keep and (not self.cache_dir or
+                             os.path.exists(self._get_cache_path(name))):
+                continue
+
+            try:
+                image = self._rasterize(name)
+            except Exception:
+                logging.exception('Unable to rasterize %s.', name)
+                continue
+
+            if keep:
+                GObject.idle_add(self._add_image, name, image)
+
+    def _add_image(self, name, image):
+        self.images.setdefault(name, image)
+        return False
+
+    def _get_scale_width(self):
         # This is for not changing all the numbers of olpcm layout,
         # that was made based on the original olpc layout.
-        scale_width = self.width
-        if _is_olpcm_model():
-            scale_width = int(scale_width * 1.1625)
+        if get_keyboard_model() == 'olpcm':
+            return int(self.width * 1.1625)
+        return self.width
+
+    def _get_cache_subdir(self):
+        # Only the images for the current size and keyboard model are kept.
+        return os.path.join(self.cache_dir, '%dx%d-%s' % (
+            self._get_scale_width(), self.height, get_keyboard_model()))
+
+    def _get_cache_path(self, name):
+        # The modification time of the SVG is part of the name, so that
+        # changed images are rasterized again.
+        filename = 'images/' + name
+        return os.path.join(self._get_cache_subdir(), '%s-%d.png' % (
+            os.path.basename(filename), int(os.path.getmtime(filename))))
+
+    def _remove_stale_caches(self):
+        if not self.cache_dir:
+            return
+
+        current = self._get_cache_subdir()
+        for path in glob.glob(os.path.join(self.cache_dir, '*')):
+            if path == current:
+                continue
+            try:
+                if os.path.isdir(path):
+                    for f in glob.glob(os.path.join(path, '*.png')):
+                        os.remove(f)
+                    os.rmdir(path)
+                elif path.endswith('.pixels'):
+                    os.remove(path)
+            except OSError:
+                logging.warning('Unable to remove image cache %s.', path)
+
+    def _rasterize(self, name):
+        scale_width = self._get_scale_width()
 
         filename = 'images/' + name
 
+        cache_path = None
+        if self.cache_dir:
+            cache_path = self._get_cache_path(name)
+
+            image = self._read_cached_image(cache_path)
+            if image:
+                return image
+
         image = GdkPixbuf.Pixbuf.new_from_file_at_scale(
             filename, scale_width, self.height, False)
-        name = os.path.basename(filename)
-        self.images[name] = image
+
+        if cache_path:
+            self._write_cached_image(cache_path, image)
+
+        return image
+
+    def _read_cached_image(self, path):
+        if not os.path.exists(path):
+            return None
+
+        try:
+            return GdkPixbuf.Pixbuf.new_from_file(path)
+        except GLib.GError:
+            logging.warning('Ignoring damaged image cache file %s.', path)
+            return None
+
+    def _write_cached_image(self, path, image):
+        cache_subdir = os.path.dirname(path)
+
+        # Write to a temporary file first, so that a concurrent reader never
+        # sees a partial image.
+        temp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        try:
+            os.makedirs(cache_subdir, exist_ok=True)
+
+            # Drop the images cached from older versions of this SVG.
+            prefix = path.rsplit('-', 1)[0] + '-'
+            for old_path in glob.glob(glob.escape(prefix) + '*.png'):
+                os.remove(old_path)
+
+            image.savev(temp_path, 'png', [], [])
+            os.rename(temp_path, path)
+        except (GLib.GError, OSError):
+            logging.warning('Unable to write image cache file %s.', path)
 
 
 class KeyboardData:
@@ -153,93 +403,199 @@ class KeyboardData:
         # This array contains the current keyboard layout.
         self.keys = None
         self.key_scan_map = None
+        self.key_label_map = None
         
         self.letter_map = {}
+        self.loaded_sigs = set()
+
+        # Reverse index of letter_map: maps each letter to the
+        # (scan, state, group) which types it with the fewest modifiers.
+        self.letter_index = {}
         
         # Access the current GTK keymap.
         # self.keymap = Gdk.Keymap.get_default()
         # Removed above line due to Gtk3 deprecation
         self.keymap = Gdk.Keymap.get_for_display(Gdk.Display.get_default())
-
-    def set_layout(self, layout): 
-        self._build_key_list(layout)
-        self._layout_keys()
+        _watch_keymap()
+
+    def set_layout(self, layout, width=None, height=None): 
+        """Sets the keyboard's layout from a layout description, optionally
+           scaling the keys to the given size.  Compiled layouts are reused
+           between keyboards."""
+        layout_key = (layout.get('layout-name'), width, height)
+        compiled = _compiled_layouts.get(layout_key)
+        if compiled is None:
+            self._build_key_list(layout)
+            if width and height:
+                self._scale_keys(width, height)
+            compiled = (self.keys, self.key_scan_map, self.key_label_map,
+                        self.layout_width, self.layout_height)
+            _compiled_layouts[layout_key] = compiled
+
+        self.keys, self.key_scan_map, self.key_label_map, \
+            self.layout_width, self.layout_height = compiled
+
+    def _scale_keys(self, width, height):
+        width_scale = float(width) / self.layout_width
+        height_scale = float(height) / self.layout_height
+        for k in self.keys:
+            k.x = int(k.x * width_scale)
+            k.y = int(k.y * height_scale)
+            k.width = int(k.width * width_scale)
+            k.height = int(k.height * height_scale)
 
     def _build_key_list(self, layout):
-        """Builds a list of Keys objects from a layout description.  
-           Also fills in derived and inherited key properties.  
+        """Builds a list of Key objects from a layout description.  
+           Also resolves inherited key properties and assigns positions and
+           sizes to the individual keys.  
            The layout description can be discarded afterwards."""
         self.keys = []
         self.key_scan_map = {}
+        self.key_label_map = {}
+
+        self.layout_width = _get_key_prop('layout-width', layout)
+        self.layout_height = _get_key_prop('layout-height', layout)
         
         group_count = 0
         for g in layout['groups']:
+            group_layout = _get_key_prop('group-layout', layout, g)
+
+            # Reset the working coordinates with each new group.
+            x = _get_key_prop('group-x', layout, g)
+            y = _get_key_prop('group-y', layout, g)
             
             key_count = 0
             for k in g['keys']:
                 
-                # Create and fill out a unique property list for this key.
-                key = k.copy()
-                
-                # Assign key and group index.
-                key['key-index'] = key_count
-                key['group-index'] = group_count
-                
-                # Inherit undefined properties from group, layout and
-                # defaults, in that order.
-                for p in KEY_PROPS:
-                    pname = p['name']
-                    if pname not in key:
-                        if pname in g:
-                            key[pname] = g[pname]
-                        elif pname in layout:
-                            key[pname] = layout[pname]
-                        else:
-                            key[pname] = p['default']
+                # Create and fill out the properties for this key, inheriting
+                # from group, layout and defaults.
+                key = Key()
+                key.index = key_count
+                key.group_index = group_count
+                key.x = _get_key_prop('key-x', layout, g, k)
+                key.y = _get_key_prop('key-y', layout, g, k)
+                key.width = _get_key_prop('key-width', layout, g, k)
+                key.height = _get_key_prop('key-height', layout, g, k)
+                key.scan = _get_key_prop('key-scan', layout, g, k)
+                key.label = _get_key_prop('key-label', layout, g, k)
+                key.hand_image = _get_key_prop('key-hand-image', layout, g, k)
+                key.finger = _get_key_prop('key-finger', layout, g, k)
+
+                # Apply the group layout algorithm.
+                if group_layout == 'horizontal':
+                    key.x = x
+                    key.y = y
+                    x += key.width + _get_key_prop('key-gap', layout, g, k)
+
+                elif group_layout == 'vertical':
+                    key.x = x
+                    key.y = y
+                    y += key.height + _get_key_prop('key-gap', layout, g, k)
+
+                else: # group_layout == 'custom' or unsupported
+                    pass
                 
                 # Add to internal list.
                 self.keys.append(key)
                 key_count += 1
            
                 # Add to scan code mapping table.
-                if key['key-scan']:
-                    self.key_scan_map[key['key-scan']] = key
+                if key.scan:
+                    self.key_scan_map[key.scan] = key
 
-            group_count += 1
+                # Add to label mapping table, keeping the first match.
+                if key.label and key.label not in self.key_label_map:
+                    self.key_label_map[key.label] = key
 
-    def _layout_keys(self):
-        """Assigns positions and sizes to the individual keys."""
-        # Note- We know self.keys is sorted by group, and by index within the group.
-        # The layout algorithms depend on this order.
-        x, y = None, None
-        cur_group = None
-        for k in self.keys:
-            # Reset the working coordinates with each new group.
-            if k['group-index'] != cur_group:
-                cur_group = k['group-index']
-                x = k['group-x']
-                y = k['group-y']
-           
-            # Apply the current layout.               
-            if k['group-layout'] == 'horizontal':
-                k['key-x'] = x
-                k['key-y'] = y
-                
-                x += k['key-width']
-                x += k['key-gap']
-            
-            elif k['group-layout'] == 'vertical':
-                k['key-x'] = x
-                k['key-y'] = y
-                
-                y += k['key-height']
-                y += k['key-gap']
-            
-            else: # k['group-layout'] == 'custom' or unsupported
-                pass
+            group_count += 1
 
     def load_letter_map(self, filename):
         self.letter_map = json.loads(open(filename, 'r').read())
+        self._build_letter_index()
+
+        # Signatures from the file take precedence over the GDK keymap.
+        self.loaded_sigs = set(self.letter_map.keys())
+
+    def _build_letter_index(self):
+        """Rebuilds the letter -> (scan, state, group) reverse index from
+           the letter map."""
+        self.letter_index = {}
+        for sig, letter in self.letter_map.items():
+            self._index_letter(sig, letter)
+
+    def _index_letter(self, sig, letter):
+        """Adds a single letter map entry to the reverse index, keeping
+           the entry with the fewest modifiers for each letter."""
+        scan, state, group = self.parse_key_sig(sig)
+        best = self.letter_index.get(letter)
+        if best is None or \
+           self._count_modifiers(state) < self._count_modifiers(best[1]):
+            self.letter_index[letter] = scan, state, group
+
+    def _count_modifiers(self, state):
+        count = 0
+        if state & Gdk.ModifierType.SHIFT_MASK: count += 1
+        if state & Gdk.ModifierType.MOD5_MASK: count += 1
+        return count
+
+    def set_letter(self, sig, letter):
+        """Adds a new entry to the letter map, keeping the index current."""
+        self.letter_map[sig] = letter
+        self._index_letter(sig, letter)
+
+    def _reindex_letters(self, letters):
+        """Recomputes the reverse index entries of the given letters."""
+        for letter in letters:
+            self.letter_index.pop(letter, None)
+        for sig, letter in self.letter_map.items():
+            if letter in letters:
+                self._index_letter(sig, letter)
+
+    def update_letters_for_scan(self, scan):
+        """Updates the letter map entries of a key from the GDK keymap,
+           after the keyboard layout changed.  Entries loaded from a letter
+           map file are kept.  Returns the signatures that changed."""
+        letters = {}
+        valid, keymap_keys, keyvals = self.keymap.get_entries_for_keycode(scan)
+        if valid:
+            for e, keyval in zip(keymap_keys, keyvals):
+                unicode = Gdk.keyval_to_unicode(keyval)
+                if not unicode:
+                    continue
+
+                # See get_key_state_group_for_letter for the level mapping.
+                state = 0
+                if e.level & 1:
+                    state |= Gdk.ModifierType.SHIFT_MASK
+                if e.level & 2:
+                    state |= Gdk.ModifierType.MOD5_MASK
+
+                sig = self.format_key_sig(scan, state, e.group)
+                letters.setdefault(sig, chr(unicode))
+
+        prefix = 'scan%d' % scan
+        old_sigs = [sig for sig in self.letter_map
+                    if (sig == prefix or sig.startswith(prefix + ' ')) and
+                       sig not in self.loaded_sigs]
+
+        changed_sigs = []
+        changed_letters = set()
+        for sig in old_sigs:
+            if sig not in letters:
+                changed_letters.add(self.letter_map.pop(sig))
+                changed_sigs.append(sig)
+        for sig, letter in letters.items():
+            if sig not in self.loaded_sigs and self.letter_map.get(sig) != letter:
+                if sig in self.letter_map:
+                    changed_letters.add(self.letter_map[sig])
+                self.letter_map[sig] = letter
+                changed_letters.add(letter)
+                changed_sigs.append(sig)
+
+        if changed_letters:
+            self._reindex_letters(changed_letters)
+
+        return changed_sigs
 
     def save_letter_map(self, filename):
         text = json.dumps(self.letter_map, ensure_ascii=False, sort_keys=True, indent=4)
@@ -277,10 +633,7 @@ class KeyboardData:
         return scan, state, group
 
     def find_key_by_label(self, label):
-        for k in self.keys:
-            if k['key-label'] == label:
-                return k
-        return None
+        return self.key_label_map.get(label)
 
     def get_key_state_group_for_letter(self, letter):
         # Special processing for some keys.
@@ -288,52 +641,38 @@ class KeyboardData:
             return self.find_key_by_label('enter'), 0, 0
 
         # Try the letter map, if loaded.
-        best_score = 3
-        best_result = None
-        
-        for sig, l in list(self.letter_map.items()):
-            if l == letter:
-                scan, state, group = self.parse_key_sig(sig)
-                
-                # Choose the key with the fewest modifiers.
-                score = 0
-                if state & Gdk.ModifierType.SHIFT_MASK: score += 1
-                if state & Gdk.ModifierType.MOD5_MASK: score += 1
-                if score < best_score:
-                    best_score = score
-                    best_result = scan, state, group
-
-        if best_result is not None:                
-            for k in self.keys:
-                if k['key-scan'] == best_result[0]:
-                    return k, best_result[1], best_result[2]
+        best_result = self.letter_index.get(letter)
+        if best_result is not None:
+            k = self.key_scan_map.get(best_result[0])
+            if k:
+                return k, best_result[1], best_result[2]
 
         # Try the GDK keymap.
         keyval = Gdk.unicode_to_keyval(ord(letter))
         valid, entries = self.keymap.get_entries_for_keyval(keyval)
         for e in entries:
-            for k in self.keys:
-                if k['key-scan'] == e.keycode:
-                    # TODO: Level -> state calculations are hardcoded to what the XO keyboard does.
-                    # They were discovered through experimentation.
-                    state = 0
-                    if e.level & 1:
-                        state |= Gdk.ModifierType.SHIFT_MASK
-                    if e.level & 2:
-                        state |= Gdk.ModifierType.MOD5_MASK
-                    return k, state, e.group
+            k = self.key_scan_map.get(e.keycode)
+            if k:
+                # TODO: Level -> state calculations are hardcoded to what the XO keyboard does.
+                # They were discovered through experimentation.
+                state = 0
+                if e.level & 1:
+                    state |= Gdk.ModifierType.SHIFT_MASK
+                if e.level & 2:
+                    state |= Gdk.ModifierType.MOD5_MASK
+                return k, state, e.group
 
         # Fail!
         return None, None, None
 
     def get_letter_for_key_state_group(self, key, state, group):
-        sig = self.format_key_sig(key['key-scan'], state, group)
+        sig = self.format_key_sig(key.scan, state, group)
         if sig in self.letter_map:
             return self.letter_map[sig]
         else:
             success, keyval, effective_group, level, consumed_modifiers = \
                 self.keymap.translate_keyboard_state(
-                    key['key-scan'], self.active_state, self.active_group)
+                    key.scan, state, group)
             if success:
                 return chr(Gdk.keyval_to_unicode(keyval)).encode('utf-8')
 
@@ -343,7 +682,7 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
     """A GTK widget which implements an interactive visual keyboard, with support
        for custom data driven layouts."""
 
-    def __init__(self, image, root_window, poll_keys=False):
+    def __init__(self, image, root_window, poll_keys=False, letters_changed_cb=None):
         KeyboardData.__init__(self)
         GObject.GObject.__init__(self)
         
@@ -363,12 +702,30 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
         self.active_group = 0
         self.active_state = 0
 
-        # still in development
-        #self.keymap.connect("keys-changed", self._keys_changed_cb)
+        # Follow keyboard layout changes while the widget is shown.
+        self.keys_changed_cb_id = None
+        self.keymap_scans = []
+        self.keymap_update_id = None
+        self.connect('realize', self._watch_keymap_cb)
+        self.connect('unrealize', self._unwatch_keymap_cb)
         
         self.hilite_letter = None
+        self.hilite_hands = None
         
         self.draw_hands = False
+
+        # Cache of rendered keyboards, one cairo surface per (state, group),
+        # with the state masked by LABEL_STATE_MASK.
+        # Only the hand overlays are drawn on top of these each frame.
+        self.key_surfaces = {}
+
+        # Cache of key images returned by get_key_pixbuf.
+        self.key_pixbufs = {}
+
+        # Called with the set of letters whose keys or key images changed,
+        # or with None if any letter may have.
+        self.letters_changed_cb = letters_changed_cb
+
         # TODO FIXME Gdk.Color.Parse() Deprecation
         self.modify_bg(Gtk.StateType.NORMAL, Gdk.Color.parse('#d0d0d0')[1])
 
@@ -387,36 +744,185 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
         self.root_window.disconnect(self.key_press_cb_id)
         self.root_window.disconnect(self.key_release_cb_id)
 
+    def _watch_keymap_cb(self, widget):
+        self.keys_changed_cb_id = self.keymap.connect('keys-changed', self._keys_changed_cb)
+
+    def _unwatch_keymap_cb(self, widget):
+        self.keymap.disconnect(self.keys_changed_cb_id)
+        self.keys_changed_cb_id = None
+
+        if self.keymap_update_id:
+            GObject.source_remove(self.keymap_update_id)
+            self.keymap_update_id = None
+
+    # Number of keys to refresh from the keymap per idle callback.
+    KEYMAP_UPDATE_BATCH = 8
+
+    def _keys_changed_cb(self, keymap):
+        # Refresh the letter map a few keys at a time from the idle loop,
+        # so that switching layouts does not stall typing.
+        self.keymap_scans = list(self.key_scan_map.keys())
+        if not self.keymap_update_id:
+            self.keymap_update_id = GObject.idle_add(self._update_keymap_cb)
+
+    def _update_keymap_cb(self):
+        scans = self.keymap_scans[:KeyboardWidget.KEYMAP_UPDATE_BATCH]
+        del self.keymap_scans[:KeyboardWidget.KEYMAP_UPDATE_BATCH]
+
+        changed_sigs = []
+        for scan in scans:
+            changed_sigs.extend(self.update_letters_for_scan(scan))
+
+        if changed_sigs:
+            self._invalidate_sigs(changed_sigs)
+
+        if self.keymap_scans:
+            return True
+
+        self.keymap_update_id = None
+        return False
+
+    def _invalidate_sigs(self, sigs):
+        """Discards the cached renderings showing any of the given key
+           signatures."""
+        sigs = set(sigs)
+        for state_group in list(self.key_surfaces.keys()):
+            for k in self.keys:
+                if self.format_key_sig(k.scan, *state_group) in sigs:
+                    del self.key_surfaces[state_group]
+                    break
+        for pixbuf_key in list(self.key_pixbufs.keys()):
+            if self.format_key_sig(*pixbuf_key[:3]) in sigs:
+                del self.key_pixbufs[pixbuf_key]
+
+        # Letters outside the letter map follow the new keymap too.
+        self._letters_changed(None)
+
+        self.hilite_hands = None
+        self.queue_draw()
+
     def set_layout(self, layout):
         """Sets the keyboard's layout from  a layout description."""
-        KeyboardData.set_layout(self, layout)
-
         # Scale the keyboard to match the images.
-        width_scale = float(self.image.width) / self.keys[0]['layout-width']
-        height_scale = float(self.image.height) / self.keys[0]['layout-height']
-        for k in self.keys:
-            k['key-x'] = int(k['key-x'] * width_scale)
-            k['key-y'] = int(k['key-y'] * height_scale)
-            k['key-width'] = int(k['key-width'] * width_scale)
-            k['key-height'] = int(k['key-height'] * height_scale)
+        KeyboardData.set_layout(self, layout, self.image.width, self.image.height)
 
-    def _draw_key(self, k, cr):
+        self.invalidate_keys()
+
+    def load_letter_map(self, filename):
+        KeyboardData.load_letter_map(self, filename)
+        self.invalidate_keys()
+
+    def set_letter(self, sig, letter):
+        scan, state, group = self.parse_key_sig(sig)
+        key = self.key_scan_map.get(scan)
+
+        old_text = None
+        if key:
+            old_text = self.get_letter_for_key_state_group(key, state, group)
+            if type(old_text) is bytes:
+                old_text = old_text.decode('utf-8')
+        old_position = self.get_key_state_group_for_letter(letter)
+
+        KeyboardData.set_letter(self, sig, letter)
+
+        changed_letters = set()
+
+        # The letter may now be typed with a different key.
+        if self.get_key_state_group_for_letter(letter) != old_position:
+            changed_letters.add(letter)
+            if letter == self.hilite_letter:
+                self.hilite_hands = None
+                self.queue_draw()
+
+        # Only the key itself is stale in the rendered keyboards, unless it
+        # already showed this letter or shows a fixed label.
+        if key and not key.label and old_text != letter:
+            changed_letters.add(letter)
+            if old_text:
+                changed_letters.add(old_text)
+
+            for state_group, surface in self.key_surfaces.items():
+                if self.format_key_sig(scan, *state_group) == sig:
+                    self._redraw_key(key, surface, *state_group)
+            for pixbuf_key in list(self.key_pixbufs.keys()):
+                if self.format_key_sig(*pixbuf_key[:3]) == sig:
+                    del self.key_pixbufs[pixbuf_key]
+
+            if self.format_key_sig(scan, self.active_state, self.active_group) == sig:
+                self._queue_draw_key(key)
+
+        if changed_letters:
+            self._letters_changed(changed_letters)
+
+    def invalidate_keys(self):
+        """Discards all cached keyboard renderings."""
+        self.key_surfaces = {}
+        self.key_pixbufs = {}
+        self._letters_changed(None)
+        self.hilite_hands = None
+        self.queue_draw()
+
+    def _letters_changed(self, letters):
+        if self.letters_changed_cb:
+            self.letters_changed_cb(letters)
+
+    def _get_screen_offset(self):
         bounds = self.get_allocation()
 
         # HACK: this is a hack used when the widget is not shown yet,
         # in that case bounds will be gtk.gdk.Rectangle(-1, -1, 1, 1)
-        # and the key will be outside the canvas. This is used only
-        # for the first key that appears below the instructions
+        # and the keyboard will be outside the canvas.
         if bounds.x == -1:
-            screen_x = screen_y = 0
+            return 0, 0
         else:
-            screen_x = int(bounds.width - self.image.width) / 2
-            screen_y = int(bounds.height - self.image.height) / 2
+            return int(bounds.width - self.image.width) // 2, \
+                   int(bounds.height - self.image.height) // 2
+
+    def _queue_draw_key(self, k):
+        screen_x, screen_y = self._get_screen_offset()
+
+        # Leave room for the outline, which is stroked over the key edges.
+        self.queue_draw_area(k.x + screen_x - 2, k.y + screen_y - 2,
+                             k.width + 4, k.height + 4)
+
+    def _get_keys_surface(self, cr):
+        """Returns the keyboard rendered for the active state and group,
+           drawing it if needed."""
+        state_group = (self.active_state, self.active_group)
+        surface = self.key_surfaces.get(state_group)
+        if surface is None:
+            surface = cr.get_target().create_similar(
+                cairo.CONTENT_COLOR_ALPHA, self.image.width, self.image.height)
+            surface_cr = cairo.Context(surface)
+            for k in self.keys:
+                self._draw_key(k, surface_cr, self.active_state, self.active_group)
+            self.key_surfaces[state_group] = surface
+        return surface
 
-        x1 = k['key-x'] + screen_x
-        y1 = k['key-y'] + screen_y
-        x2 = x1 + k['key-width']
-        y2 = y1 + k['key-height']
+    def _redraw_key(self, k, surface, state, group):
+        """Draws a key again in a rendered keyboard, along with any
+           neighbours whose outlines reach into its area."""
+        x, y = k.x - 2, k.y - 2
+        width, height = k.width + 4, k.height + 4
+
+        cr = cairo.Context(surface)
+        cr.rectangle(x, y, width, height)
+        cr.clip()
+
+        cr.set_operator(cairo.OPERATOR_CLEAR)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+
+        for other in self.keys:
+            if other.x - 2 < x + width and x < other.x + other.width + 2 and \
+               other.y - 2 < y + height and y < other.y + other.height + 2:
+                self._draw_key(other, cr, state, group)
+
+    def _draw_key(self, k, cr, state, group):
+        x1 = k.x
+        y1 = k.y
+        x2 = x1 + k.width
+        y2 = y1 + k.height
 
         corner = 5
         points = [
@@ -440,53 +946,55 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
         cr.stroke()
 
         text = ''
-        if k['key-label']:
-            text = k['key-label']
+        if k.label:
+            text = k.label
         else:
-            text = self.get_letter_for_key_state_group(
-                k, self.active_state, self.active_group)
+            text = self.get_letter_for_key_state_group(k, state, group)
 
-        cr.set_source_rgb(0, 0, 0)
-        pango_layout = PangoCairo.create_layout(cr)
-        fd = Pango.FontDescription('Monospace')
-        fd.set_size(10 * Pango.SCALE)
-        pango_layout.set_font_description(fd)
         if type(text) is bytes:
-        	pango_layout.set_text(text.decode('utf-8'), len(text.decode('utf-8')))
-        else:
-            pango_layout.set_text(text, len(text))
+            text = text.decode('utf-8')
+
+        cr.set_source_rgb(0, 0, 0)
+        pango_layout = _get_label_layout(cr, text, KEY_LABEL_SIZE)
 
         cr.move_to(x1 + 8, y2 - 23)
-        PangoCairo.update_layout(cr, pango_layout)
         PangoCairo.show_layout(cr, pango_layout)
 
-    def _expose_hands(self, cr):
-        lhand_image = self.image.get_image('OLPC_Lhand_HOMEROW.svg')
-        rhand_image = self.image.get_image('OLPC_Rhand_HOMEROW.svg')
+    def _get_hand_images(self, letter):
+        """Returns the names of the left and right hand images showing
+           how to type a letter."""
+        lhand_name = 'OLPC_Lhand_HOMEROW.svg'
+        rhand_name = 'OLPC_Rhand_HOMEROW.svg'
 
-        if self.hilite_letter:
-            key, state, group = self.get_key_state_group_for_letter(self.hilite_letter) 
+        if letter:
+            key, state, group = self.get_key_state_group_for_letter(letter)
             if key:
-                handle = self.image.get_image(key['key-hand-image'])
-                finger = key['key-finger']
+                hand_name = key.hand_image
+                finger = key.finger
 
                 # Assign the key image to the correct side.
-                if finger and handle:
+                if finger and hand_name:
                     if finger[0] == 'L':
-                        lhand_image = handle
+                        lhand_name = hand_name
                     else:
-                        rhand_image = handle
+                        rhand_name = hand_name
 
                 # Put the other hand on the SHIFT key if needed.
                 if state & Gdk.ModifierType.SHIFT_MASK:
                     if finger[0] == 'L':
-                        rhand_image = self.image.get_image('OLPC_Rhand_SHIFT.svg')
+                        rhand_name = 'OLPC_Rhand_SHIFT.svg'
                     else:
-                        lhand_image = self.image.get_image('OLPC_Lhand_SHIFT.svg')
+                        lhand_name = 'OLPC_Lhand_SHIFT.svg'
 
                 # TODO: Do something about ALTGR.
 
-        bounds = self.get_allocation()
+        return lhand_name, rhand_name
+
+    def _expose_hands(self, cr):
+        if self.hilite_hands is None:
+            self.hilite_hands = self._get_hand_images(self.hilite_letter)
+        lhand_image = self.image.get_image(self.hilite_hands[0])
+        rhand_image = self.image.get_image(self.hilite_hands[1])
 
         cr.save()
         Gdk.cairo_set_source_pixbuf(cr, lhand_image, 0, 0)
@@ -501,9 +1009,11 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
         cr.paint()
 
     def _draw_cb(self, area, cr):
-        # Draw the keys.
-        for k in self.keys:
-            self._draw_key(k, cr)
+        # Draw the keys from the cached rendering.  Cairo clips this to
+        # the invalidated area, so single key updates stay cheap.
+        screen_x, screen_y = self._get_screen_offset()
+        cr.set_source_surface(self._get_keys_surface(cr), screen_x, screen_y)
+        cr.paint()
 
         # Draw overlay images.
         if self.draw_hands:
@@ -511,10 +1021,6 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
         return True
 
     def key_press_release_cb(self, widget, event):
-        key = self.key_scan_map.get(event.hardware_keycode)
-        if key:
-            key['key-pressed'] = event.type == Gdk.EventType.KEY_PRESS
-
         # Hack to get the current modifier state - which will not be represented by the event.
         # state = Gdk.device_get_core_pointer().get_state(self.get_window())[1]
 
@@ -532,38 +1038,47 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
             else:
                 state ^= Gdk.ModifierType.MOD5_MASK
 
-        if self.active_group != event.group or self.active_state != state:
+        label_state = state & LABEL_STATE_MASK
+        if self.active_group != event.group or self.active_state != label_state:
             self.active_group = event.group
-            self.active_state = state
+            self.active_state = label_state
 
             self.queue_draw()
 
+        # set_letter redraws the key if it shows the new letter.
         if event.string:
             sig = self.format_key_sig(event.hardware_keycode, state, event.group)
             if sig not in self.letter_map:
-                self.letter_map[sig] = event.string
-                self.queue_draw()
+                self.set_letter(sig, event.string)
 
         return False
 
     def clear_hilite(self):
-        self.hilite_letter = None
-        self.queue_draw()
+        self.set_hilite_letter(None)
 
     def set_hilite_letter(self, letter):
         self.hilite_letter = letter
-        self.queue_draw()
+
+        # Only the hand overlays depend on the hilite letter, so skip the
+        # redraw if they stay the same.
+        hands = self._get_hand_images(letter)
+        if hands != self.hilite_hands:
+            self.hilite_hands = hands
+            if self.draw_hands:
+                self.queue_draw()
 
     def set_draw_hands(self, enable):
         self.draw_hands = enable
         self.queue_draw()
     
     def get_key_pixbuf(self, key, state=0, group=0, scale=1):
-        w = int(key['key-width'] * scale)
-        h = int(key['key-height'] * scale)
+        w = int(key.width * scale)
+        h = int(key.height * scale)
 
-        old_state, old_group = self.active_state, self.active_group
-        self.active_state, self.active_group = state, group
+        pixbuf_key = (key.scan, state, group, scale, w, h)
+        pixbuf = self.key_pixbufs.get(pixbuf_key)
+        if pixbuf is not None:
+            return pixbuf
 
         surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w, h)
         cr = cairo.Context(surface)
@@ -571,23 +1086,13 @@ class KeyboardWidget(KeyboardData, Gtk.DrawingArea):
         cr.rectangle(0, 0, w, h)
         cr.fill()
 
-        # Duplicate the Key to be able to change its position values
-        key = copy.deepcopy(key)
-        key['key-x'] = 0
-        key['key-y'] = 0
-
-        self._draw_key(key, cr)
+        # Draw the key at the origin of the surface.
+        cr.translate(-key.x, -key.y)
+        self._draw_key(key, cr, state, group)
 
         # Convert cairo.Surface to Pixbuf
-        pixbuf_data = io.BytesIO()
-        surface.write_to_png(pixbuf_data)
-        pxb_loader = GdkPixbuf.PixbufLoader.new_with_type('png')
-        pxb_loader.write(pixbuf_data.getvalue())
-        temp_pix = pxb_loader.get_pixbuf()
-        pxb_loader.close()
-        
-        	
-
-        self.active_state, self.active_group = old_state, old_group
+        surface.flush()
+        pixbuf = Gdk.pixbuf_get_from_surface(surface, 0, 0, w, h)
 
-        return temp_pix
+        self.key_pixbufs[pixbuf_key] = pixbuf
+        return pixbuf
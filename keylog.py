@@ -0,0 +1,148 @@
+# Copyright 2008 by Kate Scheppke and Wade Brainerd.
+# This file is part of Typing Turtle.
+#
+# Typing Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Typing Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Typing Turtle.  If not, see <http://www.gnu.org/licenses/>.
+# vi:sw=4 et
+
+# Import standard Python modules.
+import array, os, struct, sys, uuid, zlib
+
+# Character recorded for backspace presses.
+BACKSPACE_CODE = '\b'
+
+# Extension of the files keystroke logs are saved in.
+FILE_SUFFIX = '.ttkl'
+
+# A log of the keystrokes typed during a lesson.
+#
+# Keystrokes are kept in fixed size ring buffers, one array per field, so
+# that recording one costs the same no matter how long the lesson is.  When
+# the buffers are full the oldest keystrokes are overwritten.
+class KeystrokeLog:
+    # Number of keystrokes kept by default.
+    CAPACITY = 8192
+
+    # Serialized header: magic, format version and keystroke count.
+    HEADER = struct.Struct('<4sBI')
+    MAGIC = b'TTKL'
+    VERSION = 1
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+
+        self.times = array.array('d', [0.0]) * capacity
+        self.expected = array.array('I', [0]) * capacity
+        self.typed = array.array('I', [0]) * capacity
+        self.correct = array.array('B', [0]) * capacity
+
+        # Index of the oldest keystroke, and number of keystrokes kept.
+        self.first = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, expected, typed, correct):
+        """Records a keystroke.  expected and typed are single characters,
+           or empty strings if there is none."""
+        if self.count < self.capacity:
+            i = (self.first + self.count) % self.capacity
+            self.count += 1
+        else:
+            i = self.first
+            self.first = (self.first + 1) % self.capacity
+
+        self.times[i] = timestamp
+        self.expected[i] = ord(expected[:1] or '\0')
+        self.typed[i] = ord(typed[:1] or '\0')
+        self.correct[i] = 1 if correct else 0
+
+    def __iter__(self):
+        """Yields (timestamp, expected, typed, correct) tuples, oldest first."""
+        for n in range(self.count):
+            i = (self.first + n) % self.capacity
+            yield (self.times[i], chr(self.expected[i]), chr(self.typed[i]),
+                   bool(self.correct[i]))
+
+    def to_bytes(self):
+        """Returns the log as a compressed binary blob.  Times are stored as
+           milliseconds since the first keystroke."""
+        times = array.array('I')
+        expected = array.array('I')
+        typed = array.array('I')
+        correct = array.array('B')
+
+        start = None
+        for t, e, k, c in self:
+            if start is None:
+                start = t
+            times.append(int(round((t - start) * 1000)))
+            expected.append(ord(e))
+            typed.append(ord(k))
+            correct.append(c)
+
+        # Stored little endian.
+        if sys.byteorder == 'big':
+            for a in (times, expected, typed):
+                a.byteswap()
+
+        data = KeystrokeLog.HEADER.pack(KeystrokeLog.MAGIC, KeystrokeLog.VERSION, self.count)
+        data += times.tobytes() + expected.tobytes() + typed.tobytes() + correct.tobytes()
+        return zlib.compress(data, 9)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """Rebuilds a log from to_bytes() output.  Raises ValueError if the
+           blob is not a keystroke log."""
+        try:
+            data = zlib.decompress(blob)
+            magic, version, count = KeystrokeLog.HEADER.unpack_from(data)
+        except (zlib.error, struct.error):
+            raise ValueError('Not a keystroke log.')
+        if magic != KeystrokeLog.MAGIC or version != KeystrokeLog.VERSION:
+            raise ValueError('Not a keystroke log.')
+
+        offset = KeystrokeLog.HEADER.size
+        fields = []
+        for typecode in ('I', 'I', 'I', 'B'):
+            a = array.array(typecode)
+            size = a.itemsize * count
+            a.frombytes(data[offset:offset+size])
+            if sys.byteorder == 'big':
+                a.byteswap()
+            fields.append(a)
+            offset += size
+
+        log = cls(max(count, 1))
+        for t, e, k, c in zip(*fields):
+            log.append(t / 1000.0, chr(e), chr(k), c)
+        return log
+
+    def save(self, directory):
+        """Writes the log to a new file in the directory and returns the
+           name of the file."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        name = uuid.uuid4().hex + FILE_SUFFIX
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(self.to_bytes())
+        return name
+
+    @classmethod
+    def load(cls, path):
+        """Reads a log written by save().  Raises ValueError if the file is
+           not a keystroke log."""
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
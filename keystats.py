@@ -0,0 +1,166 @@
+# Copyright 2008 by Kate Scheppke and Wade Brainerd.
+# This file is part of Typing Turtle.
+#
+# Typing Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Typing Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Typing Turtle.  If not, see <http://www.gnu.org/licenses/>.
+# vi:sw=4 et
+
+# Import standard Python modules.
+import array
+
+# Upper bounds of the inter-key interval histogram buckets, in milliseconds.
+# Intervals longer than the last bound go into one extra bucket.
+INTERVAL_BUCKETS = [100, 150, 200, 300, 400, 600, 800, 1200, 2000]
+
+# Intervals longer than this, in seconds, are pauses rather than typing and
+# are not counted.
+MAX_INTERVAL = 5.0
+
+# Running per-key and per-digraph typing statistics.
+#
+# The statistics are kept in a plain dictionary so that they can be stored
+# in the Journal along with the rest of the activity data, and keep growing
+# across sessions.  Each keystroke updates them in constant time:
+#
+#   'chars':   { char: { 'count', 'errors', 'time', 'histogram' } }
+#   'bigrams': { chars: { 'count', 'errors', 'time' } }
+#
+# 'time' is the total of the counted inter-key intervals in milliseconds,
+# and 'histogram' counts those intervals by INTERVAL_BUCKETS.
+class KeyStats:
+    def __init__(self, data=None):
+        if data is None:
+            data = {}
+        self.data = data
+        self.data.setdefault('chars', {})
+        self.data.setdefault('bigrams', {})
+
+        self.reset_sequence()
+
+    def reset_sequence(self):
+        """Forgets the previous keystroke, for example when a new lesson step
+           begins, so that no interval or digraph spans the break."""
+        self.last_time = None
+        self.last_char = None
+
+    def add(self, timestamp, expected, typed, correct, advanced):
+        """Counts a keystroke which should have typed the expected character.
+           advanced tells whether the lesson moved on to the next character."""
+        interval = None
+        if self.last_time is not None and timestamp - self.last_time <= MAX_INTERVAL:
+            interval = int((timestamp - self.last_time) * 1000)
+
+        c = self.data['chars'].get(expected)
+        if c is None:
+            c = { 'count': 0, 'errors': 0, 'time': 0,
+                  'histogram': [0] * (len(INTERVAL_BUCKETS) + 1) }
+            self.data['chars'][expected] = c
+        c['count'] += 1
+        if not correct:
+            c['errors'] += 1
+        if interval is not None:
+            c['time'] += interval
+            c['histogram'][self._get_bucket(interval)] += 1
+
+        if self.last_char is not None:
+            bigram = self.last_char + expected
+            b = self.data['bigrams'].get(bigram)
+            if b is None:
+                b = { 'count': 0, 'errors': 0, 'time': 0 }
+                self.data['bigrams'][bigram] = b
+            b['count'] += 1
+            if not correct:
+                b['errors'] += 1
+            if interval is not None:
+                b['time'] += interval
+
+        self.last_time = timestamp
+
+        # Digraphs follow the text being copied, so a retried character does
+        # not pair with itself.
+        if advanced:
+            self.last_char = expected
+
+    def _get_bucket(self, interval):
+        # The bucket list is short, so a linear scan is constant time.
+        for i, bound in enumerate(INTERVAL_BUCKETS):
+            if interval <= bound:
+                return i
+        return len(INTERVAL_BUCKETS)
+
+    def get_error_rate(self, char):
+        """Returns the fraction of keystrokes for a character that were
+           mistakes, or None if it was never typed."""
+        c = self.data['chars'].get(char)
+        if not c or not c['count']:
+            return None
+        return float(c['errors']) / c['count']
+
+    def get_bigram_error_rate(self, bigram):
+        b = self.data['bigrams'].get(bigram)
+        if not b or not b['count']:
+            return None
+        return float(b['errors']) / b['count']
+
+# Rolling WPM and accuracy over the most recent keystrokes.
+#
+# Keystroke times are kept in a fixed size ring buffer, and a running count
+# of the correct ones in the window, so each update is constant time.
+class RateMeter:
+    # Number of keystrokes in the window.
+    WINDOW = 40
+
+    def __init__(self, size=WINDOW):
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.correct = array.array('B', [0]) * size
+        self.reset()
+
+    def reset(self):
+        self.next = 0
+        self.count = 0
+        self.correct_count = 0
+
+    def add(self, timestamp, correct):
+        if self.count == self.size:
+            # Drop the oldest keystroke, which is overwritten below.
+            self.correct_count -= self.correct[self.next]
+        else:
+            self.count += 1
+
+        self.times[self.next] = timestamp
+        self.correct[self.next] = 1 if correct else 0
+        self.correct_count += self.correct[self.next]
+        self.next = (self.next + 1) % self.size
+
+    def get_wpm(self, now=None):
+        """Returns the words per minute typed over the window, measured up to
+           now if given, so that the rate falls off while the user pauses."""
+        if self.count < 2:
+            return 0.0
+
+        oldest = self.times[(self.next - self.count) % self.size]
+        if now is None:
+            now = self.times[(self.next - 1) % self.size]
+        if now <= oldest:
+            return 0.0
+
+        # The first keystroke only starts the clock.
+        first = (self.next - self.count) % self.size
+        correct_count = self.correct_count - self.correct[first]
+        return 60 * (correct_count / 5.0) / (now - oldest)
+
+    def get_accuracy(self):
+        if not self.count:
+            return 0.0
+        return 100.0 * self.correct_count / self.count
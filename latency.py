@@ -0,0 +1,116 @@
+# Copyright 2008 by Kate Scheppke and Wade Brainerd.
+# This file is part of Typing Turtle.
+#
+# Typing Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Typing Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Typing Turtle.  If not, see <http://www.gnu.org/licenses/>.
+# vi:sw=4 et
+
+# Import standard Python modules.
+import array, datetime, logging, math, os, time
+
+# Input latency measurement, from key press to painted frame.
+#
+# The probe is off unless this environment variable is set to something other
+# than 0.  Set it to 1 to show the numbers on screen and log them, or to the
+# path of a file to also append them to that file.
+LATENCY_ENV = 'TYPINGTURTLE_LATENCY'
+
+def is_enabled():
+    return os.environ.get(LATENCY_ENV, '') not in ('', '0')
+
+def get_probe(name):
+    """Returns a new probe for the named screen, or None if latency
+       measurement is disabled."""
+    if not is_enabled():
+        return None
+    return LatencyProbe(name)
+
+def get_percentiles(samples, percents=(50, 95, 99)):
+    """Returns the values below which the given percentages of the samples
+       fall, by nearest rank, or None if there are no samples."""
+    if not len(samples):
+        return None
+
+    samples = sorted(samples)
+    result = []
+    for p in percents:
+        rank = max(1, int(math.ceil(p / 100.0 * len(samples))))
+        result.append(samples[min(rank, len(samples)) - 1])
+    return result
+
+# Matches key presses to the frames that show their effect.
+#
+# key_pressed() stamps a keystroke which changed the display, and painted()
+# is called when the screen draws.  Every stamped keystroke is counted as
+# painted in the first frame drawn after it.  Samples are kept in a fixed
+# size ring buffer, in milliseconds.
+class LatencyProbe:
+    # Number of samples kept.
+    SIZE = 1024
+
+    def __init__(self, name, size=SIZE):
+        self.name = name
+        self.size = size
+        self.samples = array.array('d', [0.0]) * size
+        self.next = 0
+        self.count = 0
+
+        self.pending = []
+
+    def key_pressed(self, timestamp=None):
+        """Stamps a key press whose effect has yet to be painted.  timestamp
+           must come from time.monotonic()."""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.pending.append(timestamp)
+
+    def painted(self):
+        """Records the latency of every key press stamped since the last
+           painted frame."""
+        if not self.pending:
+            return
+
+        now = time.monotonic()
+        for timestamp in self.pending:
+            self.samples[self.next] = (now - timestamp) * 1000
+            self.next = (self.next + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+        self.pending = []
+
+    def get_percentiles(self, percents=(50, 95, 99)):
+        """Returns the latencies below which the given percentages of the
+           samples fall, in milliseconds, or None if there are none yet."""
+        return get_percentiles(self.samples[:self.count], percents)
+
+    def get_summary(self):
+        percentiles = self.get_percentiles()
+        if percentiles is None:
+            return '%s latency: no samples' % self.name
+        return '%s latency: p50 %.1f ms  p95 %.1f ms  p99 %.1f ms  (%d keys)' % \
+            ((self.name,) + tuple(percentiles) + (self.count,))
+
+    def dump(self):
+        """Writes the summary to the log, and to the file named by the
+           environment variable if it is not just a flag."""
+        summary = self.get_summary()
+        logging.info(summary)
+
+        path = os.environ.get(LATENCY_ENV, '')
+        if path in ('', '0', '1'):
+            return
+
+        try:
+            with open(path, 'a') as f:
+                f.write('%s %s\n' % (datetime.datetime.now().isoformat(), summary))
+        except EnvironmentError:
+            logging.warning('Unable to write latency log %s.', path)
@@ -16,12 +16,13 @@
 # vi:sw=4 et 
 
 # Import standard Python modules.
-import logging, os, math, time, copy, locale, datetime, random, re
+import logging, os, math, time, copy, locale, datetime, random
 from gettext import gettext as _
 
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
+from gi.repository import Pango
 
 # Import Sugar UI modules.
 import sugar3.activity.activity
@@ -29,12 +30,23 @@ from sugar3.graphics import *
 
 # Import activity modules.
 import keyboard, medalscreen
+import typingsession, keystats, latency
 
 # Paragraph symbol unicode character.
 PARAGRAPH_CODE = '\xb6'
 
-# Maximium width of a text line in text lesson mode.
-LINE_WIDTH = 70
+# Fewest characters per text line, however narrow the view.
+MIN_LINE_WIDTH = 20
+
+# Number of text lines kept in the buffer above and below the one being typed.
+LINES_BEFORE = 10
+LINES_AFTER = 30
+
+# Seconds between statistics refreshes while the learner types.
+STATS_INTERVAL = 1.0
+
+# Seconds without a keystroke after which statistics stop refreshing.
+IDLE_TIMEOUT = 3.0
 
 FINGERS = {
     'LP': _('left little finger'),
@@ -68,9 +80,6 @@ class LessonScreen(Gtk.VBox):
         stopbtn.connect('clicked', self.stop_cb)
         
         # TODO- These will be replaced by graphical displays using Gtk.DrawingArea.
-        self.wpm = 0
-        self.accuracy = 0
-        
         self.wpmlabel = Gtk.Label()
         self.accuracylabel = Gtk.Label()
         
@@ -84,6 +93,12 @@ class LessonScreen(Gtk.VBox):
         hbox.pack_start(self.wpmlabel, True, False, 10)
         hbox.pack_start(self.accuracylabel, True, False, 10)
         hbox.pack_end(title, False, False, 10)
+
+        # Measure input latency if requested, showing it next to the stats.
+        self.latency = latency.get_probe('lesson')
+        if self.latency:
+            self.latencylabel = Gtk.Label()
+            hbox.pack_start(self.latencylabel, True, False, 10)
         
         # Set up font styles.
         self.tagtable = Gtk.TextTagTable()
@@ -113,6 +128,15 @@ class LessonScreen(Gtk.VBox):
         incorrect_copy_tag.props.foreground = '#ff0000'
         self.tagtable.add(incorrect_copy_tag)
         
+        # Text view marks for the lines of the current step.
+        self.line_marks = {}
+        self.line_starts = {}
+        self.typed_lines = {}
+
+        # Key step instructions and images, by character.
+        self.key_hints = {}
+        self.shown_hint = None
+
         # Set up the scrolling lesson text view.
         self.lessonbuffer = Gtk.TextBuffer.new(self.tagtable)
         self.lessontext = Gtk.TextView.new_with_buffer(self.lessonbuffer)
@@ -122,6 +146,13 @@ class LessonScreen(Gtk.VBox):
         self.lessontext.set_wrap_mode(Gtk.WrapMode.WORD)
         self.lessontext.modify_base(Gtk.StateType.NORMAL, Gdk.Color.parse('#ffffcc')[1])
         
+        self.lessontext.connect('size-allocate', self.text_size_allocate_cb)
+        if self.latency:
+            self.lessontext.connect_after('draw', self.text_draw_cb)
+        self.line_width = typingsession.LINE_WIDTH
+        self.wrap_steps = []
+        self.wrap_id = None
+        
         self.lessonscroll = Gtk.ScrolledWindow()
         self.lessonscroll.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.ALWAYS)
         self.lessonscroll.add(self.lessontext)
@@ -129,7 +160,9 @@ class LessonScreen(Gtk.VBox):
         frame = Gtk.Frame()
         frame.add(self.lessonscroll)
         
-        self.keyboard = keyboard.KeyboardWidget(self.keyboard_images, self.activity)
+        self.keyboard = keyboard.KeyboardWidget(
+            self.keyboard_images, self.activity,
+            letters_changed_cb=self.letters_changed_cb)
         
         # Attempt to load a letter map for the current locale.
         code = locale.getdefaultlocale()[0] or 'en_US'
@@ -150,7 +183,20 @@ class LessonScreen(Gtk.VBox):
         
         self.show_all()
 
-        self.timer_id = None
+        # Frame clock callback moving the cursor and refreshing the
+        # statistics, while needed.
+        self.tick_id = None
+        self.cursor_dirty = False
+        self.stats_dirty = False
+        self.stats_time = 0
+        self.key_time = 0
+
+        self.shown_wpm = None
+        self.shown_accuracy = None
+
+        # Source of lesson timestamps, which the replay tool replaces with
+        # a virtual clock.
+        self.clock = time.monotonic
         
         self.begin_lesson()
         
@@ -163,128 +209,214 @@ class LessonScreen(Gtk.VBox):
         self.activity.disconnect(self.key_press_cb_id)
         self.activity.disconnect(self.key_release_cb_id)
 
-    def start_timer(self):
-        self.start_time = time.time()
-        self.timer_id = GObject.timeout_add(1000, self.timer_cb)
+        self.stop_ticks()
+
+        if self.latency:
+            self.latency.dump()
+
+        if self.wrap_id:
+            GObject.source_remove(self.wrap_id)
+            self.wrap_id = None
+
+    def text_draw_cb(self, widget, cr):
+        self.latency.painted()
+
+    def get_line_width(self):
+        """Returns how many characters of lesson text fit on a line of the
+           text view, using the metrics of its Monospace font."""
+        width = self.lessontext.get_allocated_width() - \
+            self.lessontext.get_left_margin() - self.lessontext.get_right_margin()
+
+        context = self.lessontext.get_pango_context()
+        fd = context.get_font_description().copy()
+        fd.set_family('Monospace')
+        metrics = context.get_metrics(fd, None)
+        char_width = float(metrics.get_approximate_char_width()) / Pango.SCALE
+        if char_width <= 0:
+            return typingsession.LINE_WIDTH
+
+        # Leave room for the paragraph symbol and the cursor at the end.
+        return max(MIN_LINE_WIDTH, int(width / char_width) - 2)
+
+    def text_size_allocate_cb(self, widget, allocation):
+        # Rewrap from idle, since the buffer should not change while the
+        # view is being allocated.
+        self.line_width = self.get_line_width()
+        if self.line_width != self.session.line_width and not self.wrap_id:
+            self.wrap_id = GObject.idle_add(self.wrap_steps_cb)
+
+    def wrap_steps_cb(self):
+        if self.line_width != self.session.line_width:
+            self.apply_deltas(self.session.set_line_width(self.line_width))
+
+            # Wrap the remaining steps at the new width in the background,
+            # so that entering them does not have to.
+            self.wrap_steps = [str(step['text']) for step in
+                               self.lesson['steps'][self.session.next_step_idx:]]
+
+        if self.wrap_steps:
+            typingsession.split_lines(self.wrap_steps.pop(0), self.session.line_width)
+            return True
 
-    def stop_timer(self):
-        if self.timer_id:
-            GObject.source_remove(self.timer_id)
-        self.start_time = None
-        self.timer_id = None
+        self.wrap_id = None
+        return False
+
+    def start_ticks(self):
+        if not self.tick_id:
+            self.tick_id = self.add_tick_callback(self.tick_cb)
+
+    def stop_ticks(self):
+        if self.tick_id:
+            self.remove_tick_callback(self.tick_id)
+        self.tick_id = None
+
+    def tick_cb(self, widget, frame_clock):
+        now = self.clock()
+
+        # Refresh the totals periodically while the lesson is being timed.
+        if self.session.timer_running and now - self.stats_time >= STATS_INTERVAL:
+            self.session.update_stats(now)
+            self.stats_dirty = True
+
+        if self.cursor_dirty:
+            self.cursor_dirty = False
+            self.show_cursor()
+
+        if self.stats_dirty:
+            self.stats_dirty = False
+            self.stats_time = now
+            self.show_stats()
+
+            if self.latency:
+                self.latencylabel.set_text(self.latency.get_summary())
+
+        # Stop ticking while the learner is idle or working in another window,
+        # to let the CPU sleep.  The next keystroke starts it again.
+        if self.session.timer_running and \
+           now - self.key_time < IDLE_TIMEOUT and self.activity.is_active():
+            return True
+
+        self.tick_id = None
+        return False
 
-    def timer_cb(self):
-        self.update_stats()
-        return True
-    
     def update_stats(self):
-        if self.lesson_finished:
+        # Labels are refreshed at most once per frame, from tick_cb.
+        self.stats_dirty = True
+        self.start_ticks()
+
+    def show_cursor(self):
+        if self.session.mode != 'text' or not self.session.line:
             return
-        
-        if self.start_time:
-            self.total_time += time.time() - self.start_time
-        self.start_time = time.time()
 
-        if self.total_time >= 1.0:
-            self.wpm = 60 * (self.correct_keys / 5) / self.total_time
-            self.wpmlabel.set_markup(_('<b>WPM:</b> %(wpm)d') % { 'wpm': int(self.wpm) } )
+        iter = self.lessonbuffer.get_iter_at_mark(self.line_marks[self.session.line_idx])
+        iter.forward_chars(self.session.char_idx)
+        self.lessonbuffer.place_cursor(iter)
+
+        # Gain focus (this causes the cursor line to draw).
+        if not self.lessontext.has_focus():
+            self.lessontext.grab_focus()
+
+        # Scroll the TextView so the cursor is on screen, unless it already is.
+        location = self.lessontext.get_iter_location(iter)
+        visible = self.lessontext.get_visible_rect()
+        if location.y < visible.y or \
+           location.y + location.height > visible.y + visible.height:
+            self.lessontext.scroll_to_mark(self.lessonbuffer.get_insert(), 0,
+                                           use_align=False, xalign=0.5, yalign=0.5)
+
+    def show_stats(self):
+        if self.session.lesson_finished:
+            return
 
+        # Show the speed and accuracy over the last few keystrokes, falling
+        # back to the lesson totals until there are enough of them.
+        meter = self.session.meter
+        if meter.count >= 2:
+            wpm = meter.get_wpm(self.clock())
+            accuracy = meter.get_accuracy()
         else:
-            self.wpm = 1.0
-                
-        if self.total_keys:                
-            self.accuracy = 100.0 * self.correct_keys / self.total_keys
-            
-            self.accuracylabel.set_markup(_('<b>Accuracy:</b> %(accuracy)d%%') % { 'accuracy' : int(self.accuracy) } )
+            wpm = self.session.wpm
+            accuracy = self.session.accuracy
+
+        if self.session.total_time >= 1.0 and int(wpm) != self.shown_wpm:
+            self.shown_wpm = int(wpm)
+            self.wpmlabel.set_markup(_('<b>WPM:</b> %(wpm)d') % { 'wpm': self.shown_wpm } )
+
+        if self.session.total_keys and int(accuracy) != self.shown_accuracy:
+            self.shown_accuracy = int(accuracy)
+            self.accuracylabel.set_markup(_('<b>Accuracy:</b> %(accuracy)d%%') % { 'accuracy' : self.shown_accuracy } )
     
     def begin_lesson(self):
-        self.lesson_finished = False
-        
         self.medal = None
-        
-        self.total_keys = 0
-        self.correct_keys = 0
-        self.incorrect_keys = 0
-        
-        self.start_time = None
-        self.total_time = 0
 
-        self.next_step_idx = 0
-        self.advance_step()
+        # Per-key statistics are kept across sessions in the Journal.
+        stats = keystats.KeyStats(self.activity.data.setdefault('keystats', {}))
 
-    def wrap_line(self, line):
-        r = re.compile(r'(\W+)', re.UNICODE)
-        words = r.split(line)
-        
-        new_lines = []
-        cur_line = ''
-        for w in words:
-            # TODO: Handle single word longer than a line.
-            if not w.isspace() and len(cur_line) + len(w) > LINE_WIDTH:
-                if len(cur_line):
-                    new_lines.append(cur_line)
-                    cur_line = ''
-            cur_line += w
-        
-        if len(cur_line):
-            new_lines.append(cur_line)
-        
-        return new_lines
+        self.session = typingsession.TypingSession(self.lesson, self.get_lesson_report, stats)
+        self.apply_deltas(self.session.begin_lesson(self.clock()))
+
+    def apply_deltas(self, deltas):
+        """Updates the display with the changes reported by the session."""
+        for delta in deltas:
+            if delta[0] == 'step':
+                self.show_step()
+
+            elif delta[0] == 'insert':
+                line_idx, char_idx, text, tag_name = delta[1:]
+                self.typed_lines.setdefault(line_idx, []).insert(char_idx, (text, tag_name))
+
+                iter = self.lessonbuffer.get_iter_at_mark(self.line_marks[line_idx])
+                iter.forward_chars(char_idx)
+                self.lessonbuffer.insert_with_tags_by_name(iter, text, tag_name)
+
+            elif delta[0] == 'delete':
+                line_idx, char_idx = delta[1:]
+                del self.typed_lines[line_idx][char_idx]
+
+                iter = self.lessonbuffer.get_iter_at_mark(self.line_marks[line_idx])
+                iter.forward_chars(char_idx)
 
-    def advance_step(self):
-        # Stop the WPM timer.
-        self.stop_timer()
+                iter_end = iter.copy()
+                iter_end.forward_char()
 
-        # Clear step related variables.
-        self.line = None
-        self.line_marks = None
-       
+                self.lessonbuffer.delete(iter, iter_end)
+
+            elif delta[0] == 'stats':
+                self.update_stats()
+
+            elif delta[0] == 'end':
+                self.stop_ticks()
+                self.end_lesson()
+                return
+
+        # Keep refreshing the statistics while the session is timing.
+        if self.session.timer_running:
+            self.start_ticks()
+
+        if deltas:
+            if self.session.mode == 'text':
+                self.page_lines()
+            self.hilite_next_key()
+
+    def show_step(self):
         # TODO: Play 'step finished' sound here.
-        
-        # Set up step if a valid index.
-        if self.next_step_idx < len(self.lesson['steps']):
-            step = self.lesson['steps'][self.next_step_idx]
-            self.next_step_idx = self.next_step_idx + 1
-            
-            self.text = str(step['text'])
-            self.instructions = str(step['instructions'])
-            if 'mode' in step:
-                self.mode = step['mode']
-            else:
-                if len(self.text) == 1:
-                    self.mode = 'key'
-                else:
-                    self.mode = 'text'
-        
-        # Show report after the last step.
-        elif self.next_step_idx == len(self.lesson['steps']) and not self.lesson_finished:
-            self.lesson_finished = True
-            
-            self.instructions = self.get_lesson_report()
-            self.text = '\n'
-            self.mode = 'key'
-        
-        # Leave this screen when the lesson is finished.
-        else:
-            self.end_lesson()
-            return      
-        
-        # Fix empty steps.
-        if len(self.text) == 0:
-            self.text = '\n'
-        
+
+        for mark in list(self.line_marks.values()) + list(self.line_starts.values()):
+            self.lessonbuffer.delete_mark(mark)
+        self.line_marks = {}
+        self.line_starts = {}
+        self.typed_lines = {}
+        self.shown_hint = None
+
         # Clear the buffer *before* key steps.
         self.lessonbuffer.set_text('')
         
         # Output the instructions.        
         self.lessonbuffer.insert_with_tags_by_name(
-            self.lessonbuffer.get_end_iter(), '\n\n' + self.instructions + '\n', 'instructions')
+            self.lessonbuffer.get_end_iter(), '\n\n' + self.session.instructions + '\n', 'instructions')
         
         # Key steps have just one key to press, and show a picture of the key to be pressed beneath the text.
-        if self.mode == 'key':
-            self.lines = [self.text.replace('\n', PARAGRAPH_CODE)]
-            self.line_marks = {}
-            
+        if self.session.mode == 'key':
             self.lessonbuffer.insert_with_tags_by_name(
                 self.lessonbuffer.get_end_iter(), '\n', 'instructions')
             
@@ -296,55 +428,83 @@ class LessonScreen(Gtk.VBox):
             self.keyboard.set_draw_hands(True)
         
         # Text steps require the user to copy out the text that is displayed. 
-        elif self.mode == 'text':
-            # Split text into lines.
-            self.lines = self.text.splitlines(True)
-            
-            # Substitute paragraph codes for newlines.
-            self.lines = [l.replace('\n', PARAGRAPH_CODE) for l in self.lines]
-            
-            # Split by line length in addition to by paragraphs.
-            for i in range(0, len(self.lines)):
-                line = self.lines[i]
-                if len(line) > LINE_WIDTH:
-                    self.lines[i:i+1] = self.wrap_line(line)
-            
-            # Fill text buffer with text lines, each followed by room for the user to type.
-            self.line_marks = {} 
-            line_idx = 0
-            for l in self.lines:
-                # Add a little space between lines.
-                self.lessonbuffer.insert_with_tags_by_name(
-                    self.lessonbuffer.get_end_iter(), '\n', 'text')
-                self.lessonbuffer.insert_with_tags_by_name(
-                    self.lessonbuffer.get_end_iter(), '\n', 'spacer')
-
-                # Add the text to copy.
-                self.lessonbuffer.insert_with_tags_by_name(
-                    self.lessonbuffer.get_end_iter(), l + '\n', 'text')
-                
-                # Leave a marker where we will later insert text.
-                self.line_marks[line_idx] = self.lessonbuffer.create_mark(None, self.lessonbuffer.get_end_iter(), True)
-                
-                line_idx += 1
+        elif self.session.mode == 'text':
+            # Only the lines around the cursor are kept in the buffer, see
+            # page_lines.  first_line and end_line delimit them.
+            self.first_line = 0
+            self.end_line = 0
+            self.page_lines()
             
             self.lessontext.set_cursor_visible(True)
             
             # Enable hands for typing mode now that it's fast enough.            
             self.keyboard.set_draw_hands(True)
 
-        self.line_idx = 0
-        self.begin_line()
+    def page_lines(self):
+        """Adds and removes text lines in the buffer, so that it holds just a
+           window of lines around the one being typed.  This keeps long text
+           lessons quick to start and to lay out."""
+        line_idx = self.session.line_idx
+        first_line = max(0, line_idx - LINES_BEFORE)
+        end_line = min(len(self.session.lines), line_idx + LINES_AFTER)
+
+        while self.end_line < end_line:
+            self.insert_line(self.end_line, self.lessonbuffer.get_end_iter())
+            self.end_line += 1
+
+        while self.first_line > first_line:
+            self.first_line -= 1
+            iter = self.lessonbuffer.get_iter_at_mark(self.line_starts[self.first_line + 1])
+            self.insert_line(self.first_line, iter)
+
+        while self.first_line < first_line:
+            self.remove_line(self.first_line)
+            self.first_line += 1
+
+        # Lines below are only dropped well past the window, after moving
+        # back up with backspace.
+        while self.end_line > end_line + LINES_AFTER:
+            self.end_line -= 1
+            self.remove_line(self.end_line)
+
+    def insert_line(self, line_idx, iter):
+        """Inserts a text line at iter, followed by room for the user to type
+           and anything already typed there."""
+        start_offset = iter.get_offset()
+
+        # Add a little space between lines.
+        self.lessonbuffer.insert_with_tags_by_name(iter, '\n', 'text')
+        self.lessonbuffer.insert_with_tags_by_name(iter, '\n', 'spacer')
+
+        # Add the text to copy.
+        self.lessonbuffer.insert_with_tags_by_name(iter, self.session.lines[line_idx] + '\n', 'text')
+
+        # Leave a marker where we will later insert text.
+        self.line_marks[line_idx] = self.lessonbuffer.create_mark(None, iter, True)
+
+        for text, tag_name in self.typed_lines.get(line_idx, []):
+            self.lessonbuffer.insert_with_tags_by_name(iter, text, tag_name)
+
+        # Lines inserted above this one must go before its start marker.
+        self.line_starts[line_idx] = self.lessonbuffer.create_mark(
+            None, self.lessonbuffer.get_iter_at_offset(start_offset), False)
+
+    def remove_line(self, line_idx):
+        start = self.lessonbuffer.get_iter_at_mark(self.line_starts[line_idx])
+        if line_idx + 1 in self.line_starts:
+            end = self.lessonbuffer.get_iter_at_mark(self.line_starts[line_idx + 1])
+        else:
+            end = self.lessonbuffer.get_end_iter()
+        self.lessonbuffer.delete(start, end)
 
-    def begin_line(self):
-        self.line = self.lines[self.line_idx]
-        self.line_mark = self.line_marks[self.line_idx]
-        
-        self.char_idx = 0
-        
-        self.hilite_next_key()
+        self.lessonbuffer.delete_mark(self.line_marks.pop(line_idx))
+        self.lessonbuffer.delete_mark(self.line_starts.pop(line_idx))
 
     def key_cb(self, widget, event):
+        # Real time the key arrived, for the latency probe.  Lesson times
+        # come from self.clock, which may be virtual.
+        arrival_time = time.monotonic()
+
         # Pass events on to the keyboard.
         self.keyboard.key_press_release_cb(widget, event)
 
@@ -357,223 +517,156 @@ class LessonScreen(Gtk.VBox):
             return True
 
         # Ignore either press or release events, depending on mode.
-        if self.mode == 'key' and event.type == Gdk.EventType.KEY_PRESS:
+        if self.session.mode == 'key' and event.type == Gdk.EventType.KEY_PRESS:
             return True 
-        if self.mode != 'key' and event.type == Gdk.EventType.KEY_RELEASE:
+        if self.session.mode != 'key' and event.type == Gdk.EventType.KEY_RELEASE:
             return True
         
         # Ignore hotkeys.
         if event.get_state() & (Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.MOD1_MASK):
             return True
-        
-        # Convert Return keys to paragraph symbols.
-        if key_name == 'Return':
-            key = PARAGRAPH_CODE
-               
-        if self.mode == 'key':
-            # Check to see if they pressed the correct key.
-            if key == self.line[self.char_idx]:
-                self.correct_keys += 1
-                self.total_keys += 1
-                
-                # Advance to the next character (or else step).
-                self.char_idx += 1
-                if self.char_idx >= len(self.line):
-                    self.advance_step()
 
-                self.update_stats()
-                self.hilite_next_key()
-                
-            else:
-                # TODO - Play 'incorrect key' sound here.
-               
-                self.incorrect_keys += 1
-                self.total_keys += 1
-        
-        elif self.mode == 'text':
-            # WPM timer starts with first text mode keypress.
-            if not self.timer_id:
-                self.start_timer()
-            
-            # Handle backspace by deleting text and optionally moving up lines.
-            if key_name == 'BackSpace':
-                if self.lesson.get('options', {}).get('backspace', True):               
-                    # Move to previous line if at the end of the current one.
-                    if self.char_idx == 0 and self.line_idx > 0:
-                        self.line_idx -= 1 
-                        self.begin_line()
-                        
-                        self.char_idx = len(self.line)
-                    
-                    # Then delete the current character.
-                    if self.char_idx > 0:
-                        self.char_idx -= 1
-                        
-                        iter = self.lessonbuffer.get_iter_at_mark(self.line_mark)
-                        iter.forward_chars(self.char_idx)
-                        
-                        iter_end = iter.copy()
-                        iter_end.forward_char()
-                        
-                        self.lessonbuffer.delete(iter, iter_end)
-    
-                self.hilite_next_key()
-    
-            # Process normal key presses.
-            elif key != 0:
-                
-                # Check to see if they pressed the correct key.
-                if key == self.line[self.char_idx]:
-                    tag_name = 'correct-copy'
-                    self.correct_keys += 1
-                    self.total_keys += 1
-                elif key != self.line[self.char_idx] and key_name == 'space':
-                    tag_name = 'incorrect-copy'
-                    self.incorrect_keys += 1
-                    self.total_keys += 1
-                    key = '_'
-                else:
-                    # TODO - Play 'incorrect key' sound here.
-                    
-                    tag_name = 'incorrect-copy'
-                    self.incorrect_keys += 1
-                    self.total_keys += 1
-
-                # Insert the key into the buffer if correct or if mistakes are allowed.
-                if tag_name == 'correct-copy' or self.lesson.get('options', {}).get('mistakes', True):
-                    iter = self.lessonbuffer.get_iter_at_mark(self.line_mark)
-                    iter.forward_chars(self.char_idx)
-                    
-
-                    self.lessonbuffer.insert_with_tags_by_name(iter, key, tag_name)
-                    
-                    # Advance to the next character (or else).
-                    self.char_idx += 1
-                    if self.char_idx >= len(self.line):
-                        self.line_idx += 1
-                        if self.line_idx >= len(self.lines):
-                            self.advance_step()
-                        else:
-                            self.begin_line()
-                        return True
-                
-                self.update_stats()
-                
-                self.hilite_next_key()
+        self.key_time = self.clock()
+        deltas = self.session.key(key, key_name, self.key_time)
+        # Only keystrokes that change the lesson text are measured.
+        if self.latency and [d for d in deltas if d[0] != 'stats']:
+            self.latency.key_pressed(arrival_time)
+        self.apply_deltas(deltas)
         
         return True 
 
     def hilite_next_key(self):
-        if not self.line:
+        if not self.session.line:
             return
             
-        char = self.line[self.char_idx]
+        char = self.session.line[self.session.char_idx]
         self.keyboard.set_hilite_letter(char)
 
-        # In Text mode, move the cursor to the insert location.
-        if self.mode == 'text':
-            iter = self.lessonbuffer.get_iter_at_mark(self.line_mark)
-            iter.forward_chars(self.char_idx)
-            self.lessonbuffer.place_cursor(iter)
-            
-            # Gain focus (this causes the cursor line to draw).
-            self.lessontext.grab_focus()
-            
-            # Scroll the TextView so the cursor is on screen.
-            self.lessontext.scroll_to_mark(self.lessonbuffer.get_insert(), 0,
-                                           use_align=False, xalign=0.5, yalign=0.5)
+        line_mark = self.line_marks[self.session.line_idx]
+
+        # In Text mode, move the cursor to the insert location.  This is done
+        # once per frame from tick_cb, as each move lays out the TextView.
+        if self.session.mode == 'text':
+            self.cursor_dirty = True
+            self.start_ticks()
 
         # In Key mode, display the finger hint and the key image.
-        if self.mode == 'key':
-            iter = self.lessonbuffer.get_iter_at_mark(self.line_mark)
+        if self.session.mode == 'key':
+            # Nothing to do if the same hint is already shown.
+            if char == self.shown_hint:
+                return
+            self.shown_hint = char
+
+            iter = self.lessonbuffer.get_iter_at_mark(line_mark)
             self.lessonbuffer.delete(iter, self.lessonbuffer.get_end_iter())
 
-            # Determine what modifier keys are needed.
-            key, state, group = self.keyboard.get_key_state_group_for_letter(char)
-            
-            # Append the instructions and key images.
-            if key:
-                letter = char
-                if letter == PARAGRAPH_CODE:
-                    letter = 'enter'
-                if letter == ' ':
-                    letter = 'space'
-
-                instructions = ''                
-                
-                try:
-                    finger = FINGERS[key['key-finger']]
-                except:
-                    finger = ''
-        
-                if state == Gdk.ModifierType.SHIFT_MASK:
-                    # Choose the finger to press the SHIFT key with.
-                    if key['key-finger'][0] == 'R':
-                        shift_finger = FINGERS['LP']
-                    else:
-                        shift_finger = FINGERS['RP']
+            for piece in self.get_key_hint(char):
+                if isinstance(piece, str):
+                    self.lessonbuffer.insert(self.lessonbuffer.get_end_iter(), piece)
+                else:
+                    self.lessonbuffer.insert_pixbuf(self.lessonbuffer.get_end_iter(), piece)
 
-                    instructions = _('Press and hold the shift key with your %(finger)s, ') % { 'finger': shift_finger }
-                    instructions += _('then press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
-        
-                elif state == Gdk.ModifierType.MOD5_MASK:
-                    instructions = _('Press and hold the altgr key, ') 
-                    instructions += _('then press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
-        
-                elif state == Gdk.ModifierType.SHIFT_MASK | Gdk.ModifierType.MOD5_MASK:
-                    instructions = _('Press and hold the altgr and shift keys, ')
-                    instructions += _('then press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
-        
+            self.lessonbuffer.apply_tag_by_name('image',
+                self.lessonbuffer.get_iter_at_mark(self.line_marks[0]),
+                self.lessonbuffer.get_end_iter())
+
+    def letters_changed_cb(self, letters):
+        # Forget the hints of letters the keyboard now shows differently.
+        if letters is None:
+            self.key_hints = {}
+            self.shown_hint = None
+            return
+
+        for letter in letters:
+            self.key_hints.pop(letter, None)
+        if self.shown_hint in letters:
+            self.shown_hint = None
+
+    def get_key_hint(self, char):
+        """Returns the text and key images, in order, telling how to type a
+           character.  Each character is only worked out once per lesson,
+           unless the keyboard reports that its key changed."""
+        hint = self.key_hints.get(char)
+        if hint is not None:
+            return hint
+
+        # Determine what modifier keys are needed.
+        key, state, group = self.keyboard.get_key_state_group_for_letter(char)
+        
+        # Build the instructions and key images.
+        if key:
+            letter = char
+            if letter == PARAGRAPH_CODE:
+                letter = 'enter'
+            if letter == ' ':
+                letter = 'space'
+
+            instructions = ''                
+            
+            try:
+                finger = FINGERS[key.finger]
+            except:
+                finger = ''
+    
+            if state == Gdk.ModifierType.SHIFT_MASK:
+                # Choose the finger to press the SHIFT key with.
+                if key.finger[0] == 'R':
+                    shift_finger = FINGERS['LP']
                 else:
-                    instructions = _('Press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
+                    shift_finger = FINGERS['RP']
 
-                self.lessonbuffer.insert(self.lessonbuffer.get_end_iter(), instructions + '\n\n')
+                instructions = _('Press and hold the shift key with your %(finger)s, ') % { 'finger': shift_finger }
+                instructions += _('then press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
+    
+            elif state == Gdk.ModifierType.MOD5_MASK:
+                instructions = _('Press and hold the altgr key, ') 
+                instructions += _('then press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
+    
+            elif state == Gdk.ModifierType.SHIFT_MASK | Gdk.ModifierType.MOD5_MASK:
+                instructions = _('Press and hold the altgr and shift keys, ')
+                instructions += _('then press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
+    
+            else:
+                instructions = _('Press the %(letter)s key with your %(finger)s.') % { 'letter': letter, 'finger': finger }
 
-                if state & Gdk.ModifierType.SHIFT_MASK:
-                    shift_key = self.keyboard.find_key_by_label('shift')
-                    pixbuf = self.keyboard.get_key_pixbuf(shift_key, scale=1)
-                    self.lessonbuffer.insert_pixbuf(self.lessonbuffer.get_end_iter(), pixbuf)
-                    self.lessonbuffer.insert(self.lessonbuffer.get_end_iter(), ' ')
-                
-                if state & Gdk.ModifierType.MOD5_MASK:
-                    altgr_key = self.keyboard.find_key_by_label('altgr')
-                    pixbuf = self.keyboard.get_key_pixbuf(altgr_key, scale=1)
-                    self.lessonbuffer.insert_pixbuf(self.lessonbuffer.get_end_iter(), pixbuf)
-                    self.lessonbuffer.insert(self.lessonbuffer.get_end_iter(), ' ')
+            hint = [instructions + '\n\n']
 
-                pixbuf = self.keyboard.get_key_pixbuf(key, state, group, 1)
-                self.lessonbuffer.insert_pixbuf(self.lessonbuffer.get_end_iter(), pixbuf)
+            if state & Gdk.ModifierType.SHIFT_MASK:
+                shift_key = self.keyboard.find_key_by_label('shift')
+                hint.append(self.keyboard.get_key_pixbuf(shift_key, scale=1))
+                hint.append(' ')
+            
+            if state & Gdk.ModifierType.MOD5_MASK:
+                altgr_key = self.keyboard.find_key_by_label('altgr')
+                hint.append(self.keyboard.get_key_pixbuf(altgr_key, scale=1))
+                hint.append(' ')
 
-            else: # No key found in the keymap.
-                instructions = _("Uh oh!  Your keyboard cannot type the letter '%s'.\n") % char
-                instructions += _("Please change your keyboard settings and try this lesson again.")
-                self.lessonbuffer.insert(self.lessonbuffer.get_end_iter(), instructions + '\n\n')
+            hint.append(self.keyboard.get_key_pixbuf(key, state, group, 1))
 
-            self.lessonbuffer.apply_tag_by_name('image',
-                self.lessonbuffer.get_iter_at_mark(self.line_marks[0]),
-                self.lessonbuffer.get_end_iter())
+        else: # No key found in the keymap.
+            instructions = _("Uh oh!  Your keyboard cannot type the letter '%s'.\n") % char
+            instructions += _("Please change your keyboard settings and try this lesson again.")
+            hint = [instructions + '\n\n']
+
+        self.key_hints[char] = hint
+        return hint
                    
     def get_lesson_report(self):
-        self.update_stats()
-
         lesson_name = self.lesson['name']
         
         # Add to the lesson history.
         report = { 
             'lesson': lesson_name,
-            'time': self.total_time,
-            'wpm': self.wpm, 
-            'accuracy': self.accuracy
+            'time': self.session.total_time,
+            'wpm': self.session.wpm, 
+            'accuracy': self.session.accuracy,
+            'keystrokes': self.activity.save_keystrokes(self.session.keylog)
         }
         self.activity.add_history(report)
         
         # Show the medal screen, if one should be given.
-        got_medal = None
-        
         medals = self.lesson['medals']
-        for medal in medals:
-            if self.wpm >= medal['wpm'] and self.accuracy >= medal['accuracy']:
-                got_medal = medal['name']
+        got_medal = self.session.get_medal()
         
         if got_medal:
             # Award the medal.
@@ -582,7 +675,7 @@ class LessonScreen(Gtk.VBox):
                 'type': got_medal,
                 'date': datetime.date.today().strftime('%B %d, %Y'),
                 'nick': self.activity.nick,
-                'time': self.total_time,
+                'time': self.session.total_time,
                 'wpm': report['wpm'],
                 'accuracy': report['accuracy']
             }
@@ -625,14 +718,14 @@ class LessonScreen(Gtk.VBox):
         ]
         text += random.choice(congrats) + ' '
         
-        if self.total_time > 0:
+        if self.session.total_time > 0:
             text += _('You finished the lesson in %(time)d seconds, with %(errors)d errors.\n') % \
-                { 'time': int(self.total_time), 'errors': self.incorrect_keys }
+                { 'time': int(self.session.total_time), 'errors': self.session.incorrect_keys }
             text += _('Your words per minute (WPM) was %(wpm)d, and your accuracy was %(accuracy)d%%.\n\n') % \
                 report
         else:
             text += _('You finished the lesson with %(errors)d errors.\n') % \
-                { 'errors': self.incorrect_keys }
+                { 'errors': self.session.incorrect_keys }
             text += _('Your accuracy was %(accuracy)d%%.\n\n') % \
                 report
         
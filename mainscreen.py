@@ -110,7 +110,10 @@ class MainScreen(Gtk.VBox):
         width = int(Gdk.Screen.width())
         height = int(Gdk.Screen.height()*0.3)
 
-        self.keyboard_images = keyboard.KeyboardImages(width, height)
+        images_cache_dir = os.path.join(
+            sugar3.activity.activity.get_activity_root(), 'data', 'images')
+        self.keyboard_images = keyboard.KeyboardImages(width, height, images_cache_dir)
+        self.keyboard_images.prewarm()
         
         navbox = Gtk.HBox()
         navbox.set_spacing(10)
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+# vi: sw=4 et
+# Copyright 2008 by Kate Scheppke and Wade Brainerd.
+# This file is part of Typing Turtle.
+#
+# Typing Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Typing Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Typing Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+# Replays scripted keystrokes into a lesson, for repeatable measurements.
+#
+# Keystrokes come from a script file, or are synthesized by a simulated
+# typist from a seed.  Lessons are timed with a virtual clock, so the same
+# script always gives the same WPM, accuracy and medal.  The output is a
+# JSON report which also contains how long the replay took to process.
+#
+# Normal lessons run headless through the TypingSession engine by default.
+# With --gui the lesson screens are created for real and the keystrokes go
+# through their key_cb handlers, which needs a display, for example:
+#
+#   xvfb-run ./replay.py --gui --lesson 'Home Row Balloons' --seed 3
+#
+# Balloon games always need --gui.
+#
+# A script file is either JSON, { "seed": N, "keystrokes": [[time, char], ...] },
+# or a keystroke log saved with a lesson report, found in data/keystrokes of
+# the activity root under the name given in the report.  Backspace is '\b'
+# and Enter is the paragraph symbol.
+
+import sys, random, optparse, time
+import json
+
+# Import activity modules.
+import keylog, latency
+from typingsession import TypingSession, PARAGRAPH_CODE
+
+# Length of a balloon game tick, in seconds, as balloongame.TICK_TIME.
+BALLOON_TICK = 0.02
+
+# Balloon games taking longer than this, in seconds, are abandoned.
+MAX_GAME_TIME = 3600
+
+def error(s):
+    print("replay: ERROR: %s" % s)
+    sys.exit(1)
+
+def load_lesson(path, name):
+    """Finds a lesson in a lessons file by name or by index."""
+    with open(path, 'r') as f:
+        lessons = json.loads(f.read())['lessons']
+    lessons = sorted(lessons, key=lambda l: l['order'])
+
+    for l in lessons:
+        if l['name'] == name:
+            return l
+    try:
+        return lessons[int(name)]
+    except (ValueError, IndexError):
+        error("no lesson '%s' in %s" % (name, path))
+
+def load_script(path):
+    """Returns the seed and (time, char) keystrokes of a script file."""
+    try:
+        # A keystroke log from a lesson report.
+        log = keylog.KeystrokeLog.load(path)
+        return None, [(t, k) for t, e, k, c in log]
+    except ValueError:
+        pass
+
+    with open(path, 'r') as f:
+        try:
+            script = json.loads(f.read())
+        except ValueError:
+            error('%s is not a keystroke script' % path)
+
+    if isinstance(script, list):
+        return None, [tuple(k) for k in script]
+    return script.get('seed'), [tuple(k) for k in script['keystrokes']]
+
+def save_script(path, seed, keystrokes):
+    with open(path, 'w') as f:
+        f.write(json.dumps({ 'seed': seed, 'keystrokes': keystrokes }, ensure_ascii=False))
+
+def get_key(char):
+    """Returns the character and key name given by a keystroke."""
+    if char == keylog.BACKSPACE_CODE:
+        return '', 'BackSpace'
+    if char in (PARAGRAPH_CODE, '\n', '\r'):
+        return '\r', 'Return'
+    if char == ' ':
+        return ' ', 'space'
+    return char, char
+
+def get_timing(samples):
+    """Summarizes durations given in seconds, in milliseconds."""
+    timing = { 'count': len(samples) }
+    percentiles = latency.get_percentiles(samples)
+    if percentiles:
+        timing['mean'] = 1000 * sum(samples) / len(samples)
+        for p, value in zip((50, 95, 99), percentiles):
+            timing['p%d' % p] = 1000 * value
+    return timing
+
+# A simulated typist.
+#
+# Types the expected characters at a steady speed with some jitter, and
+# makes mistakes at the given rate, which it then sometimes corrects.
+class Typist:
+    MISTAKE_KEYS = 'abcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self, wpm, error_rate, seed):
+        self.random = random.Random(seed)
+        self.interval = 60.0 / (wpm * 5)
+        self.error_rate = error_rate
+        self.time = 0.0
+
+    def next_time(self):
+        self.time += max(0.02, self.random.gauss(self.interval, self.interval / 4))
+        return self.time
+
+    def choose(self, expected):
+        """Returns the character typed when expected is wanted."""
+        if self.random.random() < self.error_rate:
+            return self.random.choice(self.MISTAKE_KEYS.replace(expected, ''))
+        return expected
+
+    def corrects(self):
+        return self.random.random() < 0.5
+
+def synthesize_lesson(lesson, wpm, error_rate, seed):
+    """Returns the keystrokes of a simulated typist completing a lesson."""
+    typist = Typist(wpm, error_rate, seed)
+    options = lesson.get('options', {})
+
+    session = TypingSession(lesson)
+    session.begin_lesson(0)
+
+    keystrokes = []
+    ended = False
+    while not ended:
+        expected = session.line[session.char_idx]
+        typed = [typist.choose(expected)]
+
+        # Fix mistakes which moved the cursor along.
+        if typed[0] != expected and session.mode == 'text' and \
+           options.get('mistakes', True) and options.get('backspace', True) and \
+           typist.corrects():
+            typed.extend([keylog.BACKSPACE_CODE, expected])
+
+        for char in typed:
+            t = typist.next_time()
+            keystrokes.append((t, char))
+            key, key_name = get_key(char)
+            if ('end',) in session.key(key, key_name, t):
+                ended = True
+                break
+
+    return keystrokes
+
+def replay_lesson(lesson, keystrokes):
+    """Replays keystrokes into a TypingSession, without a display."""
+    session = TypingSession(lesson)
+    session.begin_lesson(0)
+
+    durations = []
+    start = time.perf_counter()
+    ended = False
+    for t, char in keystrokes:
+        key, key_name = get_key(char)
+
+        before = time.perf_counter()
+        deltas = session.key(key, key_name, t)
+        durations.append(time.perf_counter() - before)
+
+        if ('end',) in deltas:
+            ended = True
+            break
+    wall_time = time.perf_counter() - start
+
+    return {
+        'lesson': lesson['name'],
+        'finished': ended,
+        'keys': len(durations),
+        'time': session.total_time,
+        'wpm': session.wpm,
+        'accuracy': session.accuracy,
+        'medal': session.get_medal(),
+        'wall_time': wall_time,
+        'key_ms': get_timing(durations),
+    }
+
+# Stands in for the TypingTurtle activity around a lesson screen, when
+# replaying with a display.
+def make_activity():
+    from gi.repository import Gtk
+
+    class ReplayActivity(Gtk.Window):
+        def __init__(self):
+            Gtk.Window.__init__(self)
+            self.set_default_size(1200, 900)
+
+            self.nick = 'replay'
+            self.data = {
+                'motd': 'welcome',
+                'history': [],
+                'medals': {}
+            }
+
+            self.screens = []
+            self.finished = False
+
+            # Screens refresh the main screen when a medal is won.
+            self.mainscreen = self
+            self.lesson_index = 0
+
+        def push_screen(self, screen):
+            # The medal screen shown after a lesson is not replayed.
+            if self.finished:
+                return
+            self.screens.append(screen)
+            self.add(screen)
+            self.show_all()
+
+        def pop_screen(self):
+            self.remove(self.screens.pop())
+            self.finished = True
+
+        def add_history(self, entry):
+            self.data['history'].append(entry)
+
+        def show_lesson(self, index):
+            pass
+
+    return ReplayActivity()
+
+# Records the time taken to paint each frame of a window.
+class FrameTimer:
+    def __init__(self, window):
+        self.durations = []
+        self.paint_start = None
+
+        clock = window.get_frame_clock()
+        clock.connect('paint', self.paint_cb)
+        clock.connect('after-paint', self.after_paint_cb)
+
+    def paint_cb(self, clock):
+        self.paint_start = time.perf_counter()
+
+    def after_paint_cb(self, clock):
+        if self.paint_start is not None:
+            self.durations.append(time.perf_counter() - self.paint_start)
+        self.paint_start = None
+
+class GuiReplay:
+    def __init__(self, realtime):
+        from gi.repository import Gtk
+        self.Gtk = Gtk
+
+        self.realtime = realtime
+        self.start = None
+
+        self.activity = make_activity()
+        self.activity.show_all()
+        self.pump()
+
+        self.frames = FrameTimer(self.activity)
+        self.durations = []
+
+    def pump(self):
+        while self.Gtk.events_pending():
+            self.Gtk.main_iteration_do(False)
+
+    def wait(self, t):
+        """Lets the display catch up with virtual time t, when replaying in
+           real time."""
+        if not self.realtime:
+            return
+        if self.start is None:
+            self.start = time.perf_counter() - t
+        while time.perf_counter() - self.start < t:
+            if self.Gtk.events_pending():
+                self.Gtk.main_iteration_do(False)
+            else:
+                time.sleep(0.001)
+
+    def make_events(self, char, release):
+        """Returns the press and, if wanted, release events for a keystroke."""
+        from gi.repository import Gdk
+
+        key, key_name = get_key(char)
+        if key_name in ('BackSpace', 'Return'):
+            keyval = Gdk.keyval_from_name(key_name)
+            string = '\b' if key_name == 'BackSpace' else '\r'
+        else:
+            keyval = Gdk.unicode_to_keyval(ord(char))
+            string = char
+
+        # Find the key and modifiers which type the character.
+        state = 0
+        group = 0
+        hardware_keycode = 0
+        found, keys = Gdk.Keymap.get_default().get_entries_for_keyval(keyval)
+        if found and keys:
+            hardware_keycode = keys[0].keycode
+            group = keys[0].group
+            if keys[0].level & 1:
+                state |= Gdk.ModifierType.SHIFT_MASK
+            if keys[0].level & 2:
+                state |= Gdk.ModifierType.MOD5_MASK
+
+        event_types = [Gdk.EventType.KEY_PRESS]
+        if release:
+            event_types.append(Gdk.EventType.KEY_RELEASE)
+        return [ReplayKeyEvent(event_type, keyval, string, state, group, hardware_keycode)
+                for event_type in event_types]
+
+    def send(self, screen, char, release=True):
+        for event in self.make_events(char, release):
+            before = time.perf_counter()
+            screen.key_cb(self.activity, event)
+            self.pump()
+            self.durations.append(time.perf_counter() - before)
+
+    def get_report(self, wall_time):
+        self.pump()
+        return {
+            'wall_time': wall_time,
+            'event_ms': get_timing(self.durations),
+            'frame_ms': get_timing(self.frames.durations),
+        }
+
+    def replay_lesson(self, lesson, keystrokes):
+        import keyboard, lessonscreen
+
+        width = int(self.activity.get_screen().get_width() * 0.8)
+        height = int(self.activity.get_screen().get_height() * 0.3)
+        images = keyboard.KeyboardImages(width, height)
+
+        # Lesson times come from the virtual clock.
+        clock = [0.0]
+        screen = lessonscreen.LessonScreen(lesson, images, self.activity)
+        screen.clock = lambda: clock[0]
+        self.activity.push_screen(screen)
+        self.pump()
+
+        start = time.perf_counter()
+        for t, char in keystrokes:
+            if self.activity.finished:
+                break
+            self.wait(t)
+            clock[0] = t
+            self.send(screen, char)
+        wall_time = time.perf_counter() - start
+
+        report = self.get_report(wall_time)
+        report.update({
+            'lesson': lesson['name'],
+            'finished': self.activity.finished,
+            'keys': len(keystrokes),
+            'time': screen.session.total_time,
+            'wpm': screen.session.wpm,
+            'accuracy': screen.session.accuracy,
+            'medal': screen.medal['type'] if screen.medal else None,
+        })
+        return report
+
+    def replay_balloons(self, lesson, seed, keystrokes, typist):
+        """Plays a balloon game, with keystrokes from a script, or else from
+           a simulated typist aiming at the highest balloon."""
+        import balloongame
+
+        random.seed(seed)
+        game = balloongame.BalloonGame(lesson, self.activity)
+        self.activity.push_screen(game)
+        self.pump()
+
+        # Run the game loop from the virtual clock instead of the frame clock.
+        game.stop_ticks()
+
+        script = list(keystrokes or [])
+        keystrokes = []
+        next_time = typist.next_time() if typist else None
+
+        start = time.perf_counter()
+        t = 0.0
+        while not self.activity.finished and t < MAX_GAME_TIME:
+            t += BALLOON_TICK
+            self.wait(t)
+
+            before = time.perf_counter()
+            game.advance(BALLOON_TICK)
+            self.pump()
+            self.durations.append(time.perf_counter() - before)
+
+            while True:
+                if typist:
+                    if t < next_time:
+                        break
+                    if game.finished:
+                        char = PARAGRAPH_CODE
+                    else:
+                        words = [b for b in game.balloons if b.word]
+                        if not words:
+                            typist.time = t
+                            next_time = typist.next_time()
+                            break
+                        target = min(words, key=lambda b: b.y)
+                        char = typist.choose(target.word[0])
+                    keystrokes.append((next_time, char))
+                    next_time = typist.next_time()
+                else:
+                    if not script or script[0][0] > t:
+                        break
+                    char = script.pop(0)[1]
+                    keystrokes.append((t, char))
+
+                # The game only listens to key presses.
+                self.send(game, char, release=False)
+                if self.activity.finished:
+                    break
+        wall_time = time.perf_counter() - start
+
+        report = self.get_report(wall_time)
+        report.update({
+            'lesson': lesson['name'],
+            'finished': self.activity.finished,
+            'keys': len(keystrokes),
+            'time': t,
+            'score': game.score,
+            'medal': game.medal['type'] if game.medal else None,
+        })
+        return report, keystrokes
+
+# The parts of a Gdk.EventKey which the key_cb handlers look at.
+class ReplayKeyEvent:
+    def __init__(self, event_type, keyval, string, state, group, hardware_keycode):
+        self.type = event_type
+        self.keyval = keyval
+        self.string = string
+        self.state = state
+        self.group = group
+        self.hardware_keycode = hardware_keycode
+
+    def get_state(self):
+        return self.state
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--lessons", dest="lessons", default="lessons/en_US.lessons", metavar="FILE",
+                      help="Lessons file.  Default lessons/en_US.lessons.")
+    parser.add_option("--lesson", dest="lesson", default="0", metavar="NAME",
+                      help="Name or index of the lesson to replay.  Default 0.")
+    parser.add_option("--script", dest="script", metavar="FILE",
+                      help="Keystroke script to replay, instead of simulating a typist.")
+    parser.add_option("--save-script", dest="save_script", metavar="FILE",
+                      help="Write the replayed keystrokes to a script file.")
+    parser.add_option("--seed", dest="seed", type="int", default=1, metavar="N",
+                      help="Random seed of the simulated typist and balloon games.  Default 1.")
+    parser.add_option("--wpm", dest="wpm", type="float", default=30, metavar="N",
+                      help="Speed of the simulated typist.  Default 30.")
+    parser.add_option("--errors", dest="error_rate", type="float", default=0.03, metavar="RATE",
+                      help="Fraction of mistaken keys of the simulated typist.  Default 0.03.")
+    parser.add_option("--gui", dest="gui", action="store_true", default=False,
+                      help="Replay through the lesson screens.  Needs a display.")
+    parser.add_option("--realtime", dest="realtime", action="store_true", default=False,
+                      help="With --gui, replay at the speed of the keystroke times.")
+    parser.add_option("--output", dest="output", metavar="FILE",
+                      help="Write the report to a file instead of the standard output.")
+    (options, args) = parser.parse_args()
+
+    lesson = load_lesson(options.lessons, options.lesson)
+    seed = options.seed
+
+    keystrokes = None
+    if options.script:
+        script_seed, keystrokes = load_script(options.script)
+        if script_seed is not None:
+            seed = script_seed
+
+    if lesson['type'] == 'balloon':
+        if not options.gui:
+            error('balloon games need --gui')
+
+        typist = None
+        if keystrokes is None:
+            typist = Typist(options.wpm, options.error_rate, seed)
+        report, keystrokes = GuiReplay(options.realtime).replay_balloons(
+            lesson, seed, keystrokes, typist)
+
+    else:
+        if keystrokes is None:
+            keystrokes = synthesize_lesson(lesson, options.wpm, options.error_rate, seed)
+
+        if options.gui:
+            report = GuiReplay(options.realtime).replay_lesson(lesson, keystrokes)
+        else:
+            report = replay_lesson(lesson, keystrokes)
+
+    report['seed'] = seed
+
+    if options.save_script:
+        save_script(options.save_script, seed, keystrokes)
+
+    text = json.dumps(report, ensure_ascii=False, sort_keys=True, indent=4)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Ctrl-C detected, aborting.")
+        sys.exit(1)
@@ -0,0 +1,344 @@
+# Copyright 2008 by Kate Scheppke and Wade Brainerd.
+# This file is part of Typing Turtle.
+#
+# Typing Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Typing Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Typing Turtle.  If not, see <http://www.gnu.org/licenses/>.
+# vi:sw=4 et
+
+# Import standard Python modules.
+import collections, re
+
+# Import activity modules.
+import keylog, keystats
+
+# This module must not depend on Gtk, so that lessons can be run without a
+# display, for example from tests and benchmarks.
+
+# Paragraph symbol unicode character.
+PARAGRAPH_CODE = '\xb6'
+
+# Maximium width of a text line in text lesson mode, unless the view sets
+# one from its size.
+LINE_WIDTH = 70
+
+# Splits lines into words and the separators between them.
+WORD_SPLIT_RE = re.compile(r'(\W+)', re.UNICODE)
+
+# Lines of recently shown text steps, keyed by (text, line width), so that
+# restarting a lesson does not wrap its text again.  The least recently used
+# entry is dropped when the cache is full.
+_lines_cache = collections.OrderedDict()
+LINES_CACHE_SIZE = 64
+
+def wrap_line(line, line_width):
+    words = WORD_SPLIT_RE.split(line)
+
+    new_lines = []
+    cur_line = ''
+    for w in words:
+        # TODO: Handle single word longer than a line.
+        if not w.isspace() and len(cur_line) + len(w) > line_width:
+            if len(cur_line):
+                new_lines.append(cur_line)
+                cur_line = ''
+        cur_line += w
+
+    if len(cur_line):
+        new_lines.append(cur_line)
+
+    return new_lines
+
+def split_lines(text, line_width):
+    """Returns the lines a text step is typed in, at most line_width
+       characters long, with newlines replaced by paragraph codes."""
+    lines = _lines_cache.get((text, line_width))
+    if lines is not None:
+        _lines_cache.move_to_end((text, line_width))
+        return lines
+
+    # Split text into lines.
+    lines = text.splitlines(True)
+
+    # Substitute paragraph codes for newlines.
+    lines = [l.replace('\n', PARAGRAPH_CODE) for l in lines]
+
+    # Split by line length in addition to by paragraphs.
+    wrapped = []
+    for line in lines:
+        if len(line) > line_width:
+            wrapped.extend(wrap_line(line, line_width))
+        else:
+            wrapped.append(line)
+
+    if len(_lines_cache) >= LINES_CACHE_SIZE:
+        _lines_cache.popitem(last=False)
+    _lines_cache[(text, line_width)] = wrapped
+    return wrapped
+
+# The typing engine behind LessonScreen.
+#
+# A TypingSession steps through a lesson, consuming keystrokes and keeping
+# score.  Each call returns a list of deltas describing what changed, which
+# the view applies to its display:
+#
+#   ('step',)                              A new step began.
+#   ('insert', line_idx, char_idx, text, tag)  Typed text was added.
+#   ('delete', line_idx, char_idx)         A typed character was erased.
+#   ('stats',)                             WPM and accuracy were updated.
+#   ('end',)                               The lesson is over.
+#
+# Timestamps are in seconds, and only need to be consistent with each other.
+class TypingSession:
+    def __init__(self, lesson, report_cb=None, stats=None):
+        self.lesson = lesson
+
+        # Called when the final report step begins, and returns its text.
+        self.report_cb = report_cb
+
+        # Per-key statistics, which usually outlive the session.
+        if stats is None:
+            stats = keystats.KeyStats()
+        self.stats = stats
+
+        self.line_width = LINE_WIDTH
+
+    def begin_lesson(self, now):
+        self.lesson_finished = False
+
+        self.total_keys = 0
+        self.correct_keys = 0
+        self.incorrect_keys = 0
+
+        self.wpm = 0
+        self.accuracy = 0
+
+        self.start_time = None
+        self.total_time = 0
+        self.timer_running = False
+
+        # Every keystroke of the lesson, for later analysis.
+        self.keylog = keylog.KeystrokeLog()
+
+        # Speed and accuracy over the last few keystrokes.
+        self.meter = keystats.RateMeter()
+
+        self.next_step_idx = 0
+        return self.advance_step(now)
+
+    def start_timer(self, now):
+        self.start_time = now
+        self.timer_running = True
+
+    def stop_timer(self):
+        self.start_time = None
+        self.timer_running = False
+
+    def update_stats(self, now):
+        if self.lesson_finished:
+            return
+
+        if self.start_time:
+            self.total_time += now - self.start_time
+        self.start_time = now
+
+        if self.total_time >= 1.0:
+            self.wpm = 60 * (self.correct_keys / 5) / self.total_time
+        else:
+            self.wpm = 1.0
+
+        if self.total_keys:
+            self.accuracy = 100.0 * self.correct_keys / self.total_keys
+
+    def get_medal(self):
+        """Returns the name of the best medal earned with the current
+           statistics, or None."""
+        got_medal = None
+        for medal in self.lesson['medals']:
+            if self.wpm >= medal['wpm'] and self.accuracy >= medal['accuracy']:
+                got_medal = medal['name']
+        return got_medal
+
+    def set_line_width(self, line_width):
+        """Changes the number of characters per text line.  The current step
+           is wrapped again only if nothing has been typed in it yet."""
+        if line_width == self.line_width:
+            return []
+        self.line_width = line_width
+
+        if self.mode == 'text' and self.line_idx == 0 and self.char_idx == 0:
+            self.lines = split_lines(self.text, self.line_width)
+            self.begin_line()
+            return [('step',)]
+
+        return []
+
+    def advance_step(self, now):
+        # Stop the WPM timer.
+        self.stop_timer()
+        self.stats.reset_sequence()
+        self.meter.reset()
+
+        # Clear step related variables.
+        self.line = None
+
+        # Set up step if a valid index.
+        if self.next_step_idx < len(self.lesson['steps']):
+            step = self.lesson['steps'][self.next_step_idx]
+            self.next_step_idx = self.next_step_idx + 1
+
+            self.text = str(step['text'])
+            self.instructions = str(step['instructions'])
+            if 'mode' in step:
+                self.mode = step['mode']
+            else:
+                if len(self.text) == 1:
+                    self.mode = 'key'
+                else:
+                    self.mode = 'text'
+
+        # Show report after the last step.
+        elif self.next_step_idx == len(self.lesson['steps']) and not self.lesson_finished:
+            self.lesson_finished = True
+
+            self.instructions = ''
+            if self.report_cb:
+                self.instructions = self.report_cb()
+            self.text = '\n'
+            self.mode = 'key'
+
+        # Leave the lesson when it is finished.
+        else:
+            return [('end',)]
+
+        # Fix empty steps.
+        if len(self.text) == 0:
+            self.text = '\n'
+
+        # Key steps have just one key to press.
+        if self.mode == 'key':
+            self.lines = [self.text.replace('\n', PARAGRAPH_CODE)]
+
+        # Text steps require the user to copy out the text that is displayed.
+        elif self.mode == 'text':
+            self.lines = split_lines(self.text, self.line_width)
+
+        self.line_idx = 0
+        self.begin_line()
+
+        return [('step',)]
+
+    def begin_line(self):
+        self.line = self.lines[self.line_idx]
+        self.char_idx = 0
+
+    def key(self, key, key_name, now):
+        """Processes a keystroke.  key is the character typed, and key_name
+           the name of the key, as given by Gdk.keyval_name."""
+        deltas = []
+
+        # Convert Return keys to paragraph symbols.
+        if key_name == 'Return':
+            key = PARAGRAPH_CODE
+
+        if self.mode in ('key', 'text'):
+            expected = self.line[self.char_idx]
+            if key_name == 'BackSpace':
+                self.keylog.append(now, expected, keylog.BACKSPACE_CODE, False)
+            else:
+                correct = key == expected
+                self.keylog.append(now, expected, key, correct)
+
+                # Mistakes move the cursor along in text steps, if allowed.
+                advanced = correct or (self.mode == 'text' and
+                    self.lesson.get('options', {}).get('mistakes', True))
+                self.stats.add(now, expected, key, correct, advanced)
+                self.meter.add(now, correct)
+
+        if self.mode == 'key':
+            # Check to see if they pressed the correct key.
+            if key == self.line[self.char_idx]:
+                self.correct_keys += 1
+                self.total_keys += 1
+
+                # Advance to the next character (or else step).
+                self.char_idx += 1
+                if self.char_idx >= len(self.line):
+                    deltas.extend(self.advance_step(now))
+
+                self.update_stats(now)
+                deltas.append(('stats',))
+
+            else:
+                # TODO - Play 'incorrect key' sound here.
+
+                self.incorrect_keys += 1
+                self.total_keys += 1
+
+        elif self.mode == 'text':
+            # WPM timer starts with first text mode keypress.
+            if not self.timer_running:
+                self.start_timer(now)
+
+            # Handle backspace by deleting text and optionally moving up lines.
+            if key_name == 'BackSpace':
+                if self.lesson.get('options', {}).get('backspace', True):
+                    # Move to previous line if at the end of the current one.
+                    if self.char_idx == 0 and self.line_idx > 0:
+                        self.line_idx -= 1
+                        self.begin_line()
+
+                        self.char_idx = len(self.line)
+
+                    # Then delete the current character.
+                    if self.char_idx > 0:
+                        self.char_idx -= 1
+                        deltas.append(('delete', self.line_idx, self.char_idx))
+
+            # Process normal key presses.
+            else:
+
+                # Check to see if they pressed the correct key.
+                if key == self.line[self.char_idx]:
+                    tag_name = 'correct-copy'
+                    self.correct_keys += 1
+                    self.total_keys += 1
+                elif key != self.line[self.char_idx] and key_name == 'space':
+                    tag_name = 'incorrect-copy'
+                    self.incorrect_keys += 1
+                    self.total_keys += 1
+                    key = '_'
+                else:
+                    # TODO - Play 'incorrect key' sound here.
+
+                    tag_name = 'incorrect-copy'
+                    self.incorrect_keys += 1
+                    self.total_keys += 1
+
+                # Insert the key if correct or if mistakes are allowed.
+                if tag_name == 'correct-copy' or self.lesson.get('options', {}).get('mistakes', True):
+                    deltas.append(('insert', self.line_idx, self.char_idx, key, tag_name))
+
+                    # Advance to the next character (or else).
+                    self.char_idx += 1
+                    if self.char_idx >= len(self.line):
+                        self.line_idx += 1
+                        if self.line_idx >= len(self.lines):
+                            deltas.extend(self.advance_step(now))
+                        else:
+                            self.begin_line()
+                        return deltas
+
+                self.update_stats(now)
+                deltas.append(('stats',))
+
+        return deltas
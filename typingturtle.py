@@ -73,6 +73,7 @@ font_map_default.set_resolution(dpi)
 
 # Import activity modules.
 import mainscreen, editlessonlistscreen
+import keyboard
 
 # This is the main Typing Turtle activity class.
 # 
@@ -92,6 +93,9 @@ class TypingTurtle(sugar3.activity.activity.Activity):
         self.nick = profile.get_nick_name()
         
         self.wordlist = []
+
+        # Detect the keyboard model while the rest of the activity loads.
+        keyboard.start_keyboard_model_query()
         
         # All data which is saved in the Journal entry is placed in this dictionary.
         self.data = {
@@ -180,6 +184,17 @@ class TypingTurtle(sugar3.activity.activity.Activity):
     def add_history(self, entry):
         self.data['history'].append(entry)
 
+    def save_keystrokes(self, log):
+        """Saves a lesson's keystroke log in the activity's data directory.
+           Returns the name of the file, to keep in the lesson history, or
+           None if it could not be written."""
+        directory = os.path.join(self.get_activity_root(), 'data', 'keystrokes')
+        try:
+            return log.save(directory)
+        except EnvironmentError:
+            logging.warning('Unable to save the keystroke log in %s.', directory)
+            return None
+
     def read_file(self, file_path):
         if self.metadata['mime_type'] != 'text/plain':
             return